@@ -1,86 +1,551 @@
+import asyncio
 import os
-from typing import List, AsyncIterator, cast, Any
-from openai import AsyncOpenAI
+import time
+from collections import OrderedDict, deque
+from contextlib import aclosing, asynccontextmanager
+from typing import Deque, Dict, List, AsyncIterator, Optional, Set, Tuple, cast, Any
 from openai.types.chat import ChatCompletionMessageParam
-from models import ChatMessage
+from models import ChatMessage, TrainingDataItem
+from retrieval import BM25Index
+from reply_cache import ReplyCache
+from llm_router import CircuitOpenError, router_from_env
 import storage
+from stats import record_fallback, record_reply
+from metrics import ai_reply_duration, ai_stream_first_token, ai_tokens
+from app_logging import get_logger, fields
 
+logger = get_logger("ai_service")
 
-class AIService:
-    def __init__(self):
-        # Try GitHub token first, then OpenAI
-        github_token = os.getenv("GITHUB_TOKEN")
-        openai_key = os.getenv("OPENAI_API_KEY")
-        
-        if github_token:
-            # Use GitHub Models
-            self.client = AsyncOpenAI(
-                api_key=github_token,
-                base_url="https://models.inference.ai.azure.com"
-            )
-            self.model = "gpt-4o"
-        elif openai_key:
-            # Use OpenAI
-            self.client = AsyncOpenAI(api_key=openai_key)
-            self.model = "gpt-3.5-turbo"
-        else:
-            self.client = None
-            self.model = None
-    
-    async def _get_system_prompt(self) -> str:
-        """Generate system prompt with training data context"""
-        training_data = await storage.get_training_data()
-        
-        training_context = "\n\n".join([
-            f"User: {item.message}\nAssistant: {item.reply}"
-            for item in training_data
-        ])
-        
-        system_prompt = f"""You are a helpful AI assistant trained to respond to messages based on the following examples. Use these examples to understand the tone and style of responses expected, and generate appropriate replies for similar messages.
+# Retrieval settings: how many examples to put in the prompt and how many
+# (estimated) tokens they may take up
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "20"))
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
 
-Training Examples:
-{training_context}
+# Number of rendered system prompts kept per training data version
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", "256"))
+
+# Cache of generated replies for repeated inbound messages
+REPLY_CACHE_SIZE = int(os.getenv("REPLY_CACHE_SIZE", "1000"))
+REPLY_CACHE_TTL = float(os.getenv("REPLY_CACHE_TTL", "3600"))
+REPLY_CACHE_FUZZY = os.getenv("REPLY_CACHE_FUZZY", "False").lower() == "true"
+REPLY_CACHE_FUZZY_THRESHOLD = float(os.getenv("REPLY_CACHE_FUZZY_THRESHOLD", "0.85"))
+
+# Answer straight from training data when an inbound message matches a
+# training message at least this closely (1.0 = identical after normalization)
+FAST_PATH_ENABLED = os.getenv("FAST_PATH_ENABLED", "True").lower() == "true"
+FAST_PATH_THRESHOLD = float(os.getenv("FAST_PATH_THRESHOLD", "0.9"))
+
+# Deadlines (seconds) for a whole reply, and for a stream's first token and
+# the gap between its tokens; a stalled upstream gets the fallback reply
+LLM_REPLY_TIMEOUT = float(os.getenv("LLM_REPLY_TIMEOUT", "20"))
+LLM_STREAM_FIRST_TOKEN_TIMEOUT = float(os.getenv("LLM_STREAM_FIRST_TOKEN_TIMEOUT", "15"))
+LLM_STREAM_IDLE_TIMEOUT = float(os.getenv("LLM_STREAM_IDLE_TIMEOUT", "15"))
+
+# Upstream LLM concurrency shared by all callers, counted per request so hedges
+# and failovers hold a slot too. Queued customer (Messenger) calls are admitted
+# before dashboard ones; each class has its own queue limit.
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_QUEUE_LIMIT_CUSTOMER = int(os.getenv("LLM_QUEUE_LIMIT_CUSTOMER", "200"))
+LLM_QUEUE_LIMIT_DASHBOARD = int(os.getenv("LLM_QUEUE_LIMIT_DASHBOARD", "50"))
+
+# Training data scopes. A page replies from the shared items (no pageId) plus
+# its own; every page without items of its own shares one scope, and while no
+# item has a pageId all pages use the whole data set.
+ALL_PAGES = "*"
+SHARED_ONLY = ""
+
+# Static part of the system prompt. It comes first and never changes so the
+# upstream provider can reuse its prompt-prefix cache across requests.
+SYSTEM_PROMPT_PREFIX = """You are a helpful AI assistant trained to respond to messages based on the following examples. Use these examples to understand the tone and style of responses expected, and generate appropriate replies for similar messages.
 
 When responding:
 1. Use the training examples to understand the expected response style
 2. Generate a response that matches the tone and format of the training data
 3. Be helpful and contextually appropriate
 4. If the message is similar to a training example, provide a similar style response
-5. Keep responses concise and relevant"""
+5. Keep responses concise and relevant
+
+Training Examples:
+"""
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate (~4 characters per token)"""
+    return len(text) // 4 + 1
+
+
+def format_example(item: TrainingDataItem) -> str:
+    """Format a training item as a prompt example"""
+    return f"User: {item.message}\nAssistant: {item.reply}"
+
+
+class SchedulerFullError(Exception):
+    """Raised when a priority class's LLM queue is full"""
+
+
+class LLMScheduler:
+    """Global LLM concurrency cap with strict priority between classes.
+
+    A freed slot is handed straight to the oldest waiter of the most important
+    class that has one. Classes are listed most important first.
+    """
+    
+    def __init__(self, max_concurrency: int, queue_limits: "OrderedDict[str, int]"):
+        self.max_concurrency = max_concurrency
+        self.queue_limits = queue_limits
+        self._active = 0
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {name: deque() for name in queue_limits}
+        self._stats: Dict[str, Dict[str, float]] = {
+            name: {"admitted": 0, "rejected": 0, "timedOut": 0, "totalWaitMs": 0.0, "maxWaitMs": 0.0}
+            for name in queue_limits
+        }
+    
+    async def acquire(self, priority: str, timeout: Optional[float] = None):
+        """Wait up to timeout seconds for a slot.
+
+        Raises SchedulerFullError if the class's queue is full or no slot
+        frees up in time.
+        """
+        stats = self._stats[priority]
+        if self._active < self.max_concurrency and not any(self._waiters.values()):
+            self._active += 1
+            stats["admitted"] += 1
+            return
+        
+        waiters = self._waiters[priority]
+        if len(waiters) >= self.queue_limits[priority]:
+            stats["rejected"] += 1
+            raise SchedulerFullError(f"LLM queue for {priority} requests is full")
+        
+        future = asyncio.get_running_loop().create_future()
+        waiters.append(future)
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            if future in waiters:
+                waiters.remove(future)
+            stats["timedOut"] += 1
+            raise SchedulerFullError(f"Timed out waiting for an LLM slot for {priority} requests")
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as we were cancelled, pass it on
+                self.release()
+            elif future in waiters:
+                waiters.remove(future)
+            raise
+        
+        wait_ms = (time.perf_counter() - started) * 1000
+        stats["admitted"] += 1
+        stats["totalWaitMs"] += wait_ms
+        stats["maxWaitMs"] = max(stats["maxWaitMs"], wait_ms)
+    
+    def release(self):
+        """Free a slot, handing it to the most important waiter if any"""
+        for waiters in self._waiters.values():
+            while waiters:
+                future = waiters.popleft()
+                if not future.done():
+                    future.set_result(None)
+                    return
+        self._active -= 1
+    
+    @asynccontextmanager
+    async def slot(self, priority: str, timeout: Optional[float] = None):
+        await self.acquire(priority, timeout)
+        try:
+            yield
+        finally:
+            self.release()
+    
+    def stats(self) -> dict:
+        return {
+            "maxConcurrency": self.max_concurrency,
+            "active": self._active,
+            "classes": {
+                name: {
+                    "queued": len(self._waiters[name]),
+                    "queueLimit": self.queue_limits[name],
+                    "admitted": int(stats["admitted"]),
+                    "rejected": int(stats["rejected"]),
+                    "timedOut": int(stats["timedOut"]),
+                    "avgWaitMs": round(stats["totalWaitMs"] / stats["admitted"], 3) if stats["admitted"] else 0.0,
+                    "maxWaitMs": round(stats["maxWaitMs"], 3),
+                }
+                for name, stats in self._stats.items()
+            },
+        }
+
+
+class AIService:
+    def __init__(self):
+        # GitHub Models and/or OpenAI plus any extra backends, hedged and failed over
+        self.router = router_from_env()
+        self.scheduler = LLMScheduler(LLM_MAX_CONCURRENCY, OrderedDict([
+            ("customer", LLM_QUEUE_LIMIT_CUSTOMER),
+            ("dashboard", LLM_QUEUE_LIMIT_DASHBOARD),
+        ]))
+        
+        # One search index per training data scope, kept in sync incrementally
+        self.index = BM25Index()
+        self._indexes: Dict[str, BM25Index] = {ALL_PAGES: self.index}
+        self._scopes_version: Optional[int] = None
+        self._page_ids: Set[str] = set()
+        self._scope_items: Dict[str, List[TrainingDataItem]] = {}
+        self._scope_tokens: Dict[str, int] = {}
+        self._positions: Dict[str, int] = {}
+        
+        # Rendered prompts keyed on the selected example ids, for one data version
+        self._prompt_cache: "OrderedDict[Tuple[str, ...], str]" = OrderedDict()
+        self._prompt_cache_version: Optional[int] = None
+        self.prompt_cache_hits = 0
+        self.prompt_cache_misses = 0
+        self.last_prompt_chars = 0
+        self.last_prompt_tokens = 0
+        
+        self.reply_cache = ReplyCache(
+            max_size=REPLY_CACHE_SIZE,
+            ttl=REPLY_CACHE_TTL,
+            fuzzy=REPLY_CACHE_FUZZY,
+            fuzzy_threshold=REPLY_CACHE_FUZZY_THRESHOLD,
+        )
+        
+        # Which path served each generate_reply call, and how long it took
+        self.reply_paths: Dict[str, Dict[str, float]] = {}
+    
+    def _record_path(self, path: str, started: float):
+        """Count a reply served by the given path"""
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        stats = self.reply_paths.setdefault(path, {"count": 0, "totalMs": 0.0})
+        stats["count"] += 1
+        stats["totalMs"] += elapsed_ms
+        # Canned fallbacks are counted apart so they don't pass for fast replies
+        if path in ("llm", "cache", "fast_path"):
+            record_reply(elapsed_ms)
+        else:
+            record_fallback()
+        ai_reply_duration.observe(elapsed_ms / 1000, path)
+        logger.debug("Reply served", extra=fields(path=path, ms=round(elapsed_ms, 1)))
+    
+    def _scope(self, version: int, training_data: List[TrainingDataItem], page_id: Optional[str]) -> Tuple[str, List[TrainingDataItem]]:
+        """The scope key and training items a page replies from"""
+        if version != self._scopes_version:
+            self._page_ids = {item.pageId for item in training_data if item.pageId}
+            self._scope_items = {ALL_PAGES: training_data}
+            self._scope_tokens = {}
+            self._positions = {item.id: i for i, item in enumerate(training_data)}
+            self._scopes_version = version
+            for scope in [scope for scope in self._indexes if scope not in self._page_ids and scope not in (ALL_PAGES, SHARED_ONLY)]:
+                del self._indexes[scope]
         
+        if page_id is None or not self._page_ids:
+            scope = ALL_PAGES
+        else:
+            scope = page_id if page_id in self._page_ids else SHARED_ONLY
+        
+        items = self._scope_items.get(scope)
+        if items is None:
+            items = self._scope_items[scope] = [
+                item for item in training_data if not item.pageId or item.pageId == scope
+            ]
+        return scope, items
+    
+    def _index_for(self, scope: str, version: int, items: List[TrainingDataItem]) -> BM25Index:
+        index = self._indexes.get(scope)
+        if index is None:
+            index = self._indexes[scope] = BM25Index()
+        index.sync(version, items)
+        return index
+    
+    def _fast_path_match(self, message: str, version: int, scope: str, items: List[TrainingDataItem]) -> Optional[TrainingDataItem]:
+        """Return the training item to answer with directly, if any matches closely enough"""
+        if not FAST_PATH_ENABLED:
+            return None
+        
+        match = self._index_for(scope, version, items).best_match(message)
+        if match is None or match[1] < FAST_PATH_THRESHOLD:
+            return None
+        return match[0]
+    
+    def _select_examples(self, query: str, version: int, scope: str, items: List[TrainingDataItem]) -> List[TrainingDataItem]:
+        """Pick the training examples to include in the prompt for a query"""
+        index = self._index_for(scope, version, items)
+        
+        tokens = self._scope_tokens.get(scope)
+        if tokens is None:
+            tokens = self._scope_tokens[scope] = sum(estimate_tokens(format_example(item)) for item in items)
+        
+        # Small datasets fit in the prompt as a whole
+        if tokens <= PROMPT_TOKEN_BUDGET:
+            return items
+        
+        candidates = [item for item, _ in index.search(query, RETRIEVAL_TOP_K)] if query else []
+        if not candidates:
+            # Nothing relevant, fall back to the most recent examples for tone
+            candidates = list(reversed(items[-RETRIEVAL_TOP_K:]))
+        
+        selected = []
+        used_tokens = 0
+        for item in candidates:
+            tokens = estimate_tokens(format_example(item))
+            if used_tokens + tokens > PROMPT_TOKEN_BUDGET:
+                break
+            selected.append(item)
+            used_tokens += tokens
+        
+        # Keep dataset order so overlapping selections render the same way
+        selected.sort(key=lambda item: self._positions.get(item.id, 0))
+        return selected
+    
+    async def _get_system_prompt(self, query: str = "", page_id: Optional[str] = None) -> str:
+        """Generate system prompt with the page's training examples relevant to the query"""
+        version, training_data = await storage.get_training_snapshot()
+        scope, items = self._scope(version, training_data, page_id)
+        examples = self._select_examples(query, version, scope, items)
+        
+        if version != self._prompt_cache_version:
+            self._prompt_cache.clear()
+            self._prompt_cache_version = version
+        
+        key = tuple(item.id for item in examples)
+        system_prompt = self._prompt_cache.get(key)
+        if system_prompt is not None:
+            self._prompt_cache.move_to_end(key)
+            self.prompt_cache_hits += 1
+        else:
+            self.prompt_cache_misses += 1
+            system_prompt = SYSTEM_PROMPT_PREFIX + "\n\n".join([format_example(item) for item in examples])
+            self._prompt_cache[key] = system_prompt
+            if len(self._prompt_cache) > PROMPT_CACHE_SIZE:
+                self._prompt_cache.popitem(last=False)
+        
+        self.last_prompt_chars = len(system_prompt)
+        self.last_prompt_tokens = estimate_tokens(system_prompt)
         return system_prompt
     
-    async def generate_reply(self, message: str) -> str:
-        """Generate a single reply (non-streaming)"""
-        if not self.client or not self.model:
-            return "Thank you for your message. AI service is not configured."
+    def get_stats(self) -> dict:
+        """Prompt and retrieval statistics"""
+        lookups = self.prompt_cache_hits + self.prompt_cache_misses
+        return {
+            "retrieval": self.index.stats(),
+            "pageRetrieval": {scope or "shared": index.stats() for scope, index in self._indexes.items() if scope != ALL_PAGES},
+            "promptCache": {
+                "size": len(self._prompt_cache),
+                "hits": self.prompt_cache_hits,
+                "misses": self.prompt_cache_misses,
+                "hitRate": round(self.prompt_cache_hits / lookups, 4) if lookups else 0.0,
+                "lastPromptChars": self.last_prompt_chars,
+                "lastPromptTokens": self.last_prompt_tokens,
+            },
+            "replyCache": self.reply_cache.stats(),
+            "llm": self.router.stats(),
+            "scheduler": self.scheduler.stats(),
+            "replyPaths": {
+                path: {"count": int(stats["count"]), "avgMs": round(stats["totalMs"] / stats["count"], 3)}
+                for path, stats in self.reply_paths.items()
+            },
+        }
+    
+    async def _build_messages(
+        self,
+        message: str,
+        history: Optional[List[ChatMessage]],
+        page_id: Optional[str]
+    ) -> List[ChatCompletionMessageParam]:
+        """System prompt, earlier turns and the inbound message in OpenAI format"""
+        system_prompt = await self._get_system_prompt(message, page_id)
+        
+        api_messages: List[ChatCompletionMessageParam] = [
+            cast(ChatCompletionMessageParam, {"role": "system", "content": system_prompt})
+        ]
+        api_messages.extend(
+            cast(ChatCompletionMessageParam, {"role": msg.role, "content": msg.content})
+            for msg in history or []
+        )
+        api_messages.append({"role": "user", "content": message})
+        return api_messages
+    
+    async def _answer_without_llm(
+        self,
+        message: str,
+        history: Optional[List[ChatMessage]],
+        page_id: Optional[str],
+        started: float
+    ) -> Tuple[Optional[str], int, str]:
+        """Fast path, not-configured and cached answers for an inbound message.
+
+        Returns (reply, training data version, scope); reply is None when the
+        LLM has to answer.
+        """
+        version, training_data = await storage.get_training_snapshot()
+        scope, items = self._scope(version, training_data, page_id)
+        
+        # A follow-up only makes sense in context: never answer it from training
+        # data directly, and never cache or reuse a reply that depends on history
+        if not history:
+            match = self._fast_path_match(message, version, scope, items)
+            if match is not None:
+                self._record_path("fast_path", started)
+                return match.reply, version, scope
+        
+        if not self.router.configured:
+            return "Thank you for your message. AI service is not configured.", version, scope
+        
+        if not history:
+            cached = self.reply_cache.get(message, version, scope)
+            if cached is not None:
+                self._record_path("cache", started)
+                return cached, version, scope
+        
+        return None, version, scope
+    
+    def _finish_reply(
+        self,
+        message: str,
+        history: Optional[List[ChatMessage]],
+        version: int,
+        scope: str,
+        reply: Optional[str],
+        started: float
+    ) -> str:
+        """Cache and count a completed LLM reply"""
+        if not reply:
+            return "I apologize, but I could not generate a response."
+        if not history:
+            self.reply_cache.put(message, version, reply, scope)
+        self._record_path("llm", started)
+        return reply
+    
+    def _fallback_reply(self, error: Exception, started: float, partial: bool = False) -> str:
+        """Count why the LLM could not answer and return the canned reply"""
+        if isinstance(error, CircuitOpenError):
+            # Provider is known to be down, answer right away
+            self._record_path("circuit_open", started)
+        elif isinstance(error, SchedulerFullError):
+            self._record_path("overloaded", started)
+        else:
+            text = "timed out" if isinstance(error, asyncio.TimeoutError) else str(error)
+            logger.error("Error generating reply", extra=fields(error=text, partial=partial))
+            self._record_path("fallback", started)
+        return "Thank you for your message. We'll get back to you soon!"
+    
+    async def generate_reply(
+        self,
+        message: str,
+        history: Optional[List[ChatMessage]] = None,
+        priority: str = "dashboard",
+        page_id: Optional[str] = None
+    ) -> str:
+        """Generate a single reply (non-streaming), optionally continuing a conversation.
+
+        priority is the scheduler class: "customer" for live Messenger replies,
+        "dashboard" for the test and send pages. page_id picks the page's
+        training data; without it all training data is used.
+        """
+        started = time.perf_counter()
+        
+        reply, version, scope = await self._answer_without_llm(message, history, page_id, started)
+        if reply is not None:
+            return reply
         
         try:
-            system_prompt = await self._get_system_prompt()
-            
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": message}
-                ],
-                temperature=0.7,
+            api_messages = await self._build_messages(message, history, page_id)
+            # Every upstream request, hedges included, takes its own slot within the deadline
+            response = await self.router.complete(
+                api_messages,
+                timeout=LLM_REPLY_TIMEOUT,
+                slot=lambda timeout: self.scheduler.slot(priority, timeout),
+                temperature=0.7
             )
             
-            return response.choices[0].message.content or "I apologize, but I could not generate a response."
+            if response.usage is not None:
+                ai_tokens.observe(response.usage.prompt_tokens, "prompt")
+                ai_tokens.observe(response.usage.completion_tokens, "completion")
+            
+            return self._finish_reply(message, history, version, scope, response.choices[0].message.content, started)
+        
+        except Exception as e:
+            return self._fallback_reply(e, started)
+    
+    async def _stream_llm(
+        self,
+        api_messages: List[ChatCompletionMessageParam],
+        priority: str,
+        started: float
+    ) -> AsyncIterator[str]:
+        """Stream completion tokens under a scheduler slot; errors propagate to the caller"""
+        # Streams carry no usage, so token counts are estimated
+        ai_tokens.observe(sum(estimate_tokens(str(msg["content"])) for msg in api_messages), "prompt")
+        completion: List[str] = []
+        # Time spent queued for the slot counts towards the first token deadline
+        deadline = time.monotonic() + LLM_STREAM_FIRST_TOKEN_TIMEOUT
+        async with self.scheduler.slot(priority, LLM_STREAM_FIRST_TOKEN_TIMEOUT):
+            stream = self.router.stream(
+                api_messages,
+                first_token_timeout=max(deadline - time.monotonic(), 0.0),
+                idle_timeout=LLM_STREAM_IDLE_TIMEOUT,
+                temperature=0.7
+            )
+            async with aclosing(stream):
+                async for content in stream:
+                    if not completion:
+                        ai_stream_first_token.observe(time.perf_counter() - started)
+                    completion.append(content)
+                    yield content
+        ai_tokens.observe(estimate_tokens("".join(completion)), "completion")
+    
+    async def stream_message_reply(
+        self,
+        message: str,
+        history: Optional[List[ChatMessage]] = None,
+        priority: str = "dashboard",
+        page_id: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """generate_reply for one inbound message, yielding the reply as it is generated.
+
+        Fast path and cached replies come out as a single piece. If the LLM fails
+        before producing anything the usual fallback reply is yielded instead.
+        """
+        started = time.perf_counter()
+        
+        reply, version, scope = await self._answer_without_llm(message, history, page_id, started)
+        if reply is not None:
+            yield reply
+            return
+        
+        completion: List[str] = []
+        try:
+            api_messages = await self._build_messages(message, history, page_id)
+            async with aclosing(self._stream_llm(api_messages, priority, started)) as stream:
+                async for content in stream:
+                    completion.append(content)
+                    yield content
         
         except Exception as e:
-            print(f"Error generating reply: {e}")
-            return "Thank you for your message. We'll get back to you soon!"
+            fallback = self._fallback_reply(e, started, partial=bool(completion))
+            if not completion:
+                yield fallback
+            return
+        
+        reply = self._finish_reply(message, history, version, scope, "".join(completion), started)
+        if not completion:
+            yield reply
     
-    async def generate_reply_stream(self, messages: List[ChatMessage]) -> AsyncIterator[str]:
+    async def generate_reply_stream(
+        self,
+        messages: List[ChatMessage],
+        priority: str = "dashboard",
+        page_id: Optional[str] = None
+    ) -> AsyncIterator[str]:
         """Generate streaming reply"""
-        if not self.client or not self.model:
+        if not self.router.configured:
             yield "AI service is not configured."
             return
         
+        started = time.perf_counter()
         try:
-            system_prompt = await self._get_system_prompt()
+            query = next((msg.content for msg in reversed(messages) if msg.role == "user"), "")
+            system_prompt = await self._get_system_prompt(query, page_id)
             
             # Convert messages to OpenAI format
             api_messages: List[ChatCompletionMessageParam] = [
@@ -91,19 +556,17 @@ When responding:
                 for msg in messages
             ])
             
-            stream = await self.client.chat.completions.create(
-                model=self.model,
-                messages=api_messages,
-                temperature=0.7,
-                stream=True
-            )
-            
-            async for chunk in stream:
-                if chunk.choices[0].delta.content:
-                    yield chunk.choices[0].delta.content
+            # Closing this generator (client gone) closes the upstream stream too
+            async with aclosing(self._stream_llm(api_messages, priority, started)) as stream:
+                async for content in stream:
+                    yield content
+        
+        except (CircuitOpenError, SchedulerFullError):
+            yield "AI service is temporarily unavailable. Please try again shortly."
         
         except Exception as e:
-            print(f"Error generating streaming reply: {e}")
+            error = "timed out" if isinstance(e, asyncio.TimeoutError) else str(e)
+            logger.error("Error generating streaming reply", extra=fields(error=error))
             yield "An error occurred while generating the response."
 
 
@@ -0,0 +1,434 @@
+"""Benchmark and load test for the backend.
+
+Starts the app with uvicorn against local stand-ins for the OpenAI chat
+completions API and the Graph API send endpoint, then for each training data
+size replays synthetic webhook traffic and measures reply latency (webhook
+received to Graph send), /api/reply latency and storage throughput.
+
+    python benchmark.py --sizes 100,1000,10000 --rate 50 --duration 10
+    python benchmark.py --llm-latency-ms 800 --json results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+WORDS = (
+    "order shipping price refund delivery size color stock store hours open "
+    "payment card cash discount coupon return exchange warranty account "
+    "password login address phone email track package late damaged cancel"
+).split()
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * q))], 2)
+
+
+def _summary(latencies_ms: List[float]) -> Dict[str, float]:
+    return {
+        "count": len(latencies_ms),
+        "p50": _percentile(latencies_ms, 0.5),
+        "p95": _percentile(latencies_ms, 0.95),
+        "p99": _percentile(latencies_ms, 0.99),
+    }
+
+
+def synthetic_message(rng: random.Random) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 12))) + "?"
+
+
+# Stand-in servers
+def create_stub_app(llm_latency_ms: float, token_delay_ms: float, graph_latency_ms: float):
+    """OpenAI-compatible /v1/chat/completions plus a Graph /me/messages that records sends"""
+    from fastapi import FastAPI, Request
+    from fastapi.responses import StreamingResponse
+
+    app = FastAPI()
+    sends: List[dict] = []
+    reply_words = "Thanks for reaching out, we will look into your question right away".split()
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        created = int(time.time())
+        prompt_chars = sum(len(str(msg.get("content", ""))) for msg in body.get("messages", []))
+
+        if body.get("stream"):
+            async def chunks():
+                await asyncio.sleep(llm_latency_ms / 1000)
+                for word in reply_words:
+                    chunk = {
+                        "id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": created,
+                        "model": body.get("model", "bench"),
+                        "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}],
+                    }
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                    await asyncio.sleep(token_delay_ms / 1000)
+                yield "data: [DONE]\n\n"
+            return StreamingResponse(chunks(), media_type="text/event-stream")
+
+        await asyncio.sleep((llm_latency_ms + token_delay_ms * len(reply_words)) / 1000)
+        return {
+            "id": "chatcmpl-bench", "object": "chat.completion", "created": created,
+            "model": body.get("model", "bench"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": " ".join(reply_words)},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_chars // 4,
+                "completion_tokens": len(reply_words),
+                "total_tokens": prompt_chars // 4 + len(reply_words),
+            },
+        }
+
+    @app.post("/me/messages")
+    async def send_message(request: Request):
+        body = await request.json()
+        await asyncio.sleep(graph_latency_ms / 1000)
+        recipient_id = body["recipient"]["id"]
+        if "sender_action" in body:
+            return {"recipient_id": recipient_id}
+        sends.append({"recipientId": recipient_id, "at": time.time()})
+        return {"recipient_id": recipient_id, "message_id": f"m_{len(sends)}"}
+
+    @app.get("/_bench/sends")
+    async def get_sends(since: int = 0):
+        return sends[since:]
+
+    return app
+
+
+def run_stub(port: int, llm_latency_ms: float, token_delay_ms: float, graph_latency_ms: float):
+    import uvicorn
+    app = create_stub_app(llm_latency_ms, token_delay_ms, graph_latency_ms)
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+class Process:
+    """A child process serving HTTP on a local port"""
+
+    def __init__(self, args: List[str], port: int, env: Optional[Dict[str, str]] = None, log_path: Optional[str] = None):
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self._log = open(log_path, "w") if log_path else subprocess.DEVNULL
+        self._proc = subprocess.Popen(args, cwd=BACKEND_DIR, env=env, stdout=self._log, stderr=subprocess.STDOUT)
+
+    async def wait_ready(self, path: str = "/", timeout: float = 20.0):
+        deadline = time.monotonic() + timeout
+        async with httpx.AsyncClient() as client:
+            while time.monotonic() < deadline:
+                if self._proc.poll() is not None:
+                    raise RuntimeError(f"Process on port {self.port} exited with {self._proc.returncode}")
+                try:
+                    await client.get(self.url + path)
+                    return
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+        raise RuntimeError(f"Process on port {self.port} did not start in {timeout}s")
+
+    def stop(self):
+        self._proc.terminate()
+        try:
+            self._proc.wait(10)
+        except subprocess.TimeoutExpired:
+            self._proc.kill()
+        if self._log is not subprocess.DEVNULL:
+            self._log.close()
+
+
+def seed_training_data(data_dir: str, size: int, rng: random.Random) -> List[str]:
+    """Write size synthetic training items, returns their messages"""
+    os.makedirs(data_dir, exist_ok=True)
+    items = []
+    for i in range(size):
+        items.append({
+            "id": str(1700000000000 + i),
+            "message": synthetic_message(rng),
+            "reply": f"Synthetic answer number {i}.",
+            "timestamp": "2024-01-01T00:00:00",
+        })
+    with open(os.path.join(data_dir, "training-data.json"), "w", encoding="utf-8") as f:
+        json.dump(items, f)
+    return [item["message"] for item in items]
+
+
+def webhook_body(page_id: str, sender_id: str, mid: str, text: str) -> dict:
+    return {
+        "object": "page",
+        "entry": [{
+            "id": page_id,
+            "time": int(time.time() * 1000),
+            "messaging": [{
+                "sender": {"id": sender_id},
+                "recipient": {"id": page_id},
+                "timestamp": int(time.time() * 1000),
+                "message": {"mid": mid, "text": text},
+            }],
+        }],
+    }
+
+
+async def replay_webhooks(
+    client: httpx.AsyncClient,
+    backend: Process,
+    stub: Process,
+    messages: List[str],
+    rate: float,
+    duration: float,
+    known_ratio: float,
+    rng: random.Random,
+    run_id: str,
+) -> dict:
+    """Send webhook events at a fixed rate and time each reply until its Graph send"""
+    sends_before = len((await client.get(f"{stub.url}/_bench/sends")).json())
+    sent_at: Dict[str, float] = {}
+    statuses: Dict[int, int] = {}
+    total = int(rate * duration)
+
+    async def post(i: int):
+        sender_id = f"{run_id}-{i}"
+        use_known = messages and rng.random() < known_ratio
+        text = rng.choice(messages) if use_known else synthetic_message(rng)
+        sent_at[sender_id] = time.time()
+        try:
+            response = await client.post(
+                f"{backend.url}/api/webhook/facebook",
+                json=webhook_body("bench-page", sender_id, f"mid.{sender_id}", text)
+            )
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        except httpx.HTTPError:
+            statuses[0] = statuses.get(0, 0) + 1
+
+    # Open loop: events go out on schedule whatever the backend's latency
+    started = time.monotonic()
+    tasks = []
+    for i in range(total):
+        delay = started + i / rate - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(post(i)))
+    await asyncio.gather(*tasks)
+
+    # Wait for the replies to arrive at the Graph stand-in
+    replies: List[dict] = []
+    deadline = time.monotonic() + max(30.0, duration)
+    while time.monotonic() < deadline:
+        sends = (await client.get(f"{stub.url}/_bench/sends", params={"since": sends_before})).json()
+        replies = [send for send in sends if send["recipientId"] in sent_at]
+        if len(replies) >= statuses.get(200, 0):
+            break
+        await asyncio.sleep(0.2)
+    elapsed = time.monotonic() - started
+
+    latencies = [(send["at"] - sent_at[send["recipientId"]]) * 1000 for send in replies]
+    return {
+        "events": total,
+        "accepted": statuses.get(200, 0),
+        "rejected": total - statuses.get(200, 0),
+        "replied": len(latencies),
+        "repliesPerSecond": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latencyMs": _summary(latencies),
+    }
+
+
+async def bench_reply_endpoint(client: httpx.AsyncClient, backend: Process, requests: int, concurrency: int, rng: random.Random) -> dict:
+    """Closed-loop /api/reply latency"""
+    latencies: List[float] = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.post(f"{backend.url}/api/reply", json={"message": synthetic_message(rng)})
+            if response.status_code == 200:
+                latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    elapsed = time.perf_counter() - started
+    return {
+        "requestsPerSecond": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latencyMs": _summary(latencies),
+    }
+
+
+async def bench_storage(client: httpx.AsyncClient, backend: Process, writes: int, concurrency: int, rng: random.Random) -> dict:
+    """Concurrent training writes and full training data reads"""
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = 0
+
+    async def write():
+        nonlocal failures
+        async with semaphore:
+            response = await client.post(
+                f"{backend.url}/api/train",
+                json={"message": synthetic_message(rng), "reply": "Benchmark reply."}
+            )
+            if response.status_code != 200:
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(write() for _ in range(writes)))
+    write_elapsed = time.perf_counter() - started
+
+    read_latencies: List[float] = []
+    for _ in range(5):
+        started = time.perf_counter()
+        await client.get(f"{backend.url}/api/training-data")
+        read_latencies.append((time.perf_counter() - started) * 1000)
+
+    return {
+        "writesPerSecond": round((writes - failures) / write_elapsed, 2) if write_elapsed else 0.0,
+        "writeFailures": failures,
+        "fullReadMs": _summary(read_latencies),
+    }
+
+
+async def run_scenario(args: argparse.Namespace, stub: Process, size: int, workdir: str) -> dict:
+    rng = random.Random(args.seed + size)
+    data_dir = os.path.join(workdir, f"data-{size}")
+    messages = seed_training_data(data_dir, size, rng)
+
+    port = _free_port()
+    env = dict(
+        os.environ,
+        DATA_DIR=data_dir,
+        GITHUB_TOKEN="",
+        OPENAI_API_KEY="bench",
+        OPENAI_BASE_URL=f"{stub.url}/v1",
+        GRAPH_API_BASE_URL=stub.url,
+        STORAGE_BACKEND=args.storage,
+        SQLITE_PATH=os.path.join(data_dir, "fb-reply.db"),
+        COALESCE_DELAY_MS="0",
+        GRAPH_SEND_RATE="100000",
+        GRAPH_SEND_BURST="100000",
+    )
+    backend = Process(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        port,
+        env=env,
+        log_path=os.path.join(workdir, f"backend-{size}.log"),
+    )
+    try:
+        await backend.wait_ready()
+        limits = httpx.Limits(max_connections=args.concurrency * 4)
+        async with httpx.AsyncClient(timeout=60.0, limits=limits) as client:
+            await client.post(f"{backend.url}/api/facebook/config", json={
+                "pageId": "bench-page",
+                "pageName": "Benchmark",
+                "accessToken": "bench-token",
+                "verifyToken": "bench-verify",
+                "webhookUrl": "",
+                "isConnected": True,
+            })
+            # Warm up the snapshot, retrieval index and connections
+            await bench_reply_endpoint(client, backend, 10, 2, rng)
+
+            result = {
+                "trainingItems": size,
+                "webhook": await replay_webhooks(
+                    client, backend, stub, messages, args.rate, args.duration, args.known_ratio, rng, f"s{size}"
+                ),
+                "reply": await bench_reply_endpoint(client, backend, args.requests, args.concurrency, rng),
+                "storage": await bench_storage(client, backend, args.writes, args.concurrency, rng),
+            }
+            result["serverStats"] = (await client.get(f"{backend.url}/api/stats")).json()
+            return result
+    finally:
+        backend.stop()
+
+
+def print_result(result: dict):
+    webhook, reply, storage = result["webhook"], result["reply"], result["storage"]
+    print(f"\n== {result['trainingItems']} training items ==")
+    print(
+        f"webhook  {webhook['replied']}/{webhook['events']} replied, {webhook['rejected']} rejected, "
+        f"{webhook['repliesPerSecond']} replies/s, latency ms p50 {webhook['latencyMs']['p50']} "
+        f"p95 {webhook['latencyMs']['p95']} p99 {webhook['latencyMs']['p99']}"
+    )
+    print(
+        f"reply    {reply['requestsPerSecond']} req/s, latency ms p50 {reply['latencyMs']['p50']} "
+        f"p95 {reply['latencyMs']['p95']} p99 {reply['latencyMs']['p99']}"
+    )
+    print(
+        f"storage  {storage['writesPerSecond']} writes/s ({storage['writeFailures']} failed), "
+        f"full read ms p50 {storage['fullReadMs']['p50']}"
+    )
+
+
+async def main(args: argparse.Namespace):
+    workdir = tempfile.mkdtemp(prefix="fb-reply-bench-")
+    stub_port = _free_port()
+    stub = Process(
+        [sys.executable, os.path.abspath(__file__), "--stub", "--stub-port", str(stub_port),
+         "--llm-latency-ms", str(args.llm_latency_ms), "--token-delay-ms", str(args.token_delay_ms),
+         "--graph-latency-ms", str(args.graph_latency_ms)],
+        stub_port,
+        log_path=os.path.join(workdir, "stub.log"),
+    )
+    print(f"Benchmark working directory: {workdir}")
+
+    results = []
+    try:
+        await stub.wait_ready("/docs")
+        for size in args.sizes:
+            result = await run_scenario(args, stub, size, workdir)
+            print_result(result)
+            results.append(result)
+    finally:
+        stub.stop()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the backend against local OpenAI and Graph API stand-ins")
+    parser.add_argument("--sizes", default="100,1000,10000", help="comma separated training data sizes")
+    parser.add_argument("--rate", type=float, default=50, help="webhook events per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of webhook traffic per scenario")
+    parser.add_argument("--known-ratio", type=float, default=0.3, help="share of messages copied from training data")
+    parser.add_argument("--requests", type=int, default=200, help="/api/reply requests per scenario")
+    parser.add_argument("--writes", type=int, default=200, help="/api/train writes per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--storage", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--llm-latency-ms", type=float, default=300, help="stand-in LLM time to first token")
+    parser.add_argument("--token-delay-ms", type=float, default=10, help="stand-in LLM delay per streamed token")
+    parser.add_argument("--graph-latency-ms", type=float, default=30, help="stand-in Graph API send latency")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="also write results to this file")
+    parser.add_argument("--stub", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--stub-port", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.sizes = [int(size) for size in str(args.sizes).split(",") if size]
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.stub:
+        run_stub(args.stub_port, args.llm_latency_ms, args.token_delay_ms, args.graph_latency_ms)
+    else:
+        asyncio.run(main(args))
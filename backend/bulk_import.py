@@ -0,0 +1,192 @@
+import codecs
+import csv
+import io
+import json
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import AsyncIterator, Iterable, List, Optional
+from pydantic import ValidationError
+from models import TrainingDataCreate, TrainingDataItem
+import storage
+from app_logging import get_logger, fields
+
+logger = get_logger("bulk_import")
+
+# Rows validated per batch, and how many finished imports keep their progress
+BULK_BATCH_SIZE = 1000
+MAX_TRACKED_IMPORTS = 20
+MAX_REPORTED_ERRORS = 20
+
+_imports: "OrderedDict[str, dict]" = OrderedDict()
+
+
+def get_import_progress(import_id: str) -> Optional[dict]:
+    """Get the progress of a running or recent import"""
+    return _imports.get(import_id)
+
+
+def _start_progress(import_id: str) -> dict:
+    progress = {
+        "id": import_id,
+        "status": "running",
+        "received": 0,
+        "valid": 0,
+        "invalid": 0,
+        "duplicates": 0,
+        "imported": 0,
+        "errors": [],
+        "startedAt": datetime.utcnow().isoformat(),
+        "elapsedMs": 0.0,
+    }
+    _imports[import_id] = progress
+    while len(_imports) > MAX_TRACKED_IMPORTS:
+        _imports.popitem(last=False)
+    return progress
+
+
+async def _iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Decode a byte stream into lines (newline kept)"""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        lines = buffer.split("\n")
+        buffer = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer
+
+
+async def iter_ndjson_rows(chunks: AsyncIterator[bytes]) -> AsyncIterator[dict]:
+    """Parse NDJSON rows; lines that are not JSON objects come out as {"_error": ...}"""
+    async for line in _iter_lines(chunks):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield {"_error": f"Invalid JSON: {e}"}
+            continue
+        yield row if isinstance(row, dict) else {"_error": "Expected a JSON object"}
+
+
+async def iter_csv_rows(chunks: AsyncIterator[bytes]) -> AsyncIterator[dict]:
+    """Parse CSV rows with a header line, allowing quoted fields across lines"""
+    header: Optional[List[str]] = None
+    record = ""
+    async for line in _iter_lines(chunks):
+        record += line
+        # A record is complete once its quotes are balanced
+        if record.count('"') % 2:
+            continue
+
+        fields = next(csv.reader([record]), [])
+        record = ""
+        if not any(field.strip() for field in fields):
+            continue
+        if header is None:
+            header = [field.strip().lower() for field in fields]
+            continue
+        yield dict(zip(header, fields))
+
+    if record.strip():
+        yield {"_error": "Unterminated quoted field"}
+
+
+def _row_page_id(row: dict) -> Optional[str]:
+    # CSV headers are lowercased, and NDJSON page ids may be numbers
+    value = row.get("pageId", row.get("pageid"))
+    return str(value) if value not in (None, "") else None
+
+
+async def import_training_data(
+    rows: AsyncIterator[dict],
+    import_id: str,
+    dedupe: bool = True,
+    page_id: Optional[str] = None
+) -> dict:
+    """Validate rows in batches and add them to the training data in one write.
+
+    Rows without a pageId of their own get page_id (None: shared by all pages).
+    """
+    progress = _start_progress(import_id)
+    started = time.perf_counter()
+    items: List[TrainingDataItem] = []
+    batch: List[dict] = []
+
+    def validate(batch_rows: List[dict]):
+        for row in batch_rows:
+            line = progress["valid"] + progress["invalid"] + 1
+            error = row.get("_error")
+            if error is None:
+                try:
+                    data = TrainingDataCreate(
+                        message=row.get("message"),
+                        reply=row.get("reply"),
+                        pageId=_row_page_id(row) or page_id
+                    )
+                    if data.message.strip() and data.reply.strip():
+                        items.append(TrainingDataItem(
+                            id=storage.new_id(),
+                            message=data.message.strip(),
+                            reply=data.reply.strip(),
+                            timestamp=datetime.utcnow().isoformat(),
+                            pageId=data.pageId or None
+                        ))
+                        progress["valid"] += 1
+                        continue
+                    error = "Message and reply are required"
+                except ValidationError as e:
+                    error = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+
+            progress["invalid"] += 1
+            if len(progress["errors"]) < MAX_REPORTED_ERRORS:
+                progress["errors"].append({"row": line, "error": error})
+
+    try:
+        async for row in rows:
+            progress["received"] += 1
+            batch.append(row)
+            if len(batch) >= BULK_BATCH_SIZE:
+                validate(batch)
+                batch = []
+                progress["elapsedMs"] = round((time.perf_counter() - started) * 1000, 1)
+        validate(batch)
+
+        added = await storage.add_training_items(items, dedupe=dedupe)
+        progress["imported"] = len(added)
+        progress["duplicates"] = len(items) - len(added)
+        progress["status"] = "done"
+    except Exception as e:
+        progress["status"] = "failed"
+        progress["errors"].append({"row": None, "error": str(e)})
+        raise
+    finally:
+        progress["elapsedMs"] = round((time.perf_counter() - started) * 1000, 1)
+        logger.info("Bulk import finished", extra=fields(
+            id=import_id, status=progress["status"], imported=progress["imported"],
+            duplicates=progress["duplicates"], invalid=progress["invalid"], ms=progress["elapsedMs"]
+        ))
+
+    return progress
+
+
+def export_ndjson(items: Iterable[TrainingDataItem]) -> Iterable[str]:
+    for item in items:
+        yield item.model_dump_json(exclude_none=True) + "\n"
+
+
+def export_csv(items: Iterable[TrainingDataItem]) -> Iterable[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["id", "message", "reply", "timestamp", "pageId"])
+    for item in items:
+        writer.writerow([item.id, item.message, item.reply, item.timestamp, item.pageId or ""])
+        if buffer.tell() >= 1 << 16:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
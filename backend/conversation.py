@@ -0,0 +1,206 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Deque, List, Optional, Tuple
+from models import ChatMessage
+from app_logging import get_logger, fields
+
+logger = get_logger("conversation")
+
+# Per-sender Messenger conversation memory: turns kept per sender, the token
+# budget of the history sent to the model, how many senders and characters
+# are kept in memory overall, and how long an idle conversation is remembered.
+# CONVERSATION_MAX_TURNS=0 turns the memory off.
+# With CONVERSATION_SPILL_DIR set, evicted conversations are written there and
+# picked up again when the sender returns.
+CONVERSATION_MAX_TURNS = int(os.getenv("CONVERSATION_MAX_TURNS", "10"))
+CONVERSATION_TOKEN_BUDGET = int(os.getenv("CONVERSATION_TOKEN_BUDGET", "1000"))
+CONVERSATION_MAX_SENDERS = int(os.getenv("CONVERSATION_MAX_SENDERS", "10000"))
+CONVERSATION_MAX_CHARS = int(os.getenv("CONVERSATION_MAX_CHARS", str(8 * 1024 * 1024)))
+CONVERSATION_IDLE_TTL = float(os.getenv("CONVERSATION_IDLE_TTL", "3600"))
+CONVERSATION_SPILL_DIR = os.getenv("CONVERSATION_SPILL_DIR", "")
+
+
+def conversation_key(page_id: Optional[str], sender_id: str) -> str:
+    return f"{page_id or ''}:{sender_id}"
+
+
+class Conversation:
+    """Ring buffer of a sender's most recent (role, content) turns"""
+
+    __slots__ = ("turns", "chars", "last_active")
+
+    def __init__(self, max_turns: int):
+        self.turns: Deque[Tuple[str, str]] = deque(maxlen=max_turns)
+        self.chars = 0
+        self.last_active = time.time()
+
+    def append(self, role: str, content: str):
+        if not self.turns.maxlen:
+            return
+        if len(self.turns) == self.turns.maxlen:
+            self.chars -= len(self.turns[0][1])
+        self.turns.append((role, content))
+        self.chars += len(content)
+        self.last_active = time.time()
+
+
+class ConversationStore:
+    """In-memory conversations with LRU eviction of idle senders and optional spill to disk"""
+
+    def __init__(
+        self,
+        max_turns: int = 10,
+        token_budget: int = 1000,
+        max_senders: int = 10000,
+        max_chars: int = 8 * 1024 * 1024,
+        idle_ttl: float = 3600.0,
+        spill_dir: str = "",
+    ):
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.max_senders = max_senders
+        self.max_chars = max_chars
+        self.idle_ttl = idle_ttl
+        self.spill_dir = spill_dir
+        self._conversations: "OrderedDict[str, Conversation]" = OrderedDict()
+        self._chars = 0
+
+        self.evicted = 0
+        self.expired = 0
+        self.spilled = 0
+        self.restored = 0
+
+    def __len__(self) -> int:
+        return len(self._conversations)
+
+    def _spill_path(self, key: str) -> str:
+        return os.path.join(self.spill_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+    def _write_spill(self, key: str, conversation: Conversation):
+        os.makedirs(self.spill_dir, exist_ok=True)
+        with open(self._spill_path(key), "w", encoding="utf-8") as f:
+            json.dump({"lastActive": conversation.last_active, "turns": list(conversation.turns)}, f, ensure_ascii=False)
+
+    def _read_spill(self, key: str) -> Optional[Conversation]:
+        path = self._spill_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            os.remove(path)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if time.time() - data.get("lastActive", 0) > self.idle_ttl:
+            return None
+        conversation = Conversation(self.max_turns)
+        for role, content in data.get("turns", []):
+            conversation.append(role, content)
+        conversation.last_active = data["lastActive"]
+        return conversation
+
+    def _remove(self, key: str) -> Conversation:
+        conversation = self._conversations.pop(key)
+        self._chars -= conversation.chars
+        return conversation
+
+    async def _evict(self):
+        """Expire idle conversations, then evict least recently used ones over the caps"""
+        now = time.time()
+        while self._conversations:
+            key, conversation = next(iter(self._conversations.items()))
+            if now - conversation.last_active > self.idle_ttl:
+                self._remove(key)
+                self.expired += 1
+                continue
+            if len(self._conversations) <= self.max_senders and self._chars <= self.max_chars:
+                break
+
+            conversation = self._remove(key)
+            self.evicted += 1
+            if self.spill_dir:
+                try:
+                    await asyncio.to_thread(self._write_spill, key, conversation)
+                    self.spilled += 1
+                except OSError as e:
+                    logger.error("Error spilling conversation", extra=fields(error=str(e)))
+
+    async def _get(self, key: str) -> Optional[Conversation]:
+        conversation = self._conversations.get(key)
+        if conversation is not None:
+            if time.time() - conversation.last_active > self.idle_ttl:
+                self._remove(key)
+                self.expired += 1
+                return None
+            self._conversations.move_to_end(key)
+            return conversation
+
+        if not self.spill_dir:
+            return None
+        conversation = await asyncio.to_thread(self._read_spill, key)
+        if conversation is not None:
+            self.restored += 1
+            self._conversations[key] = conversation
+            self._chars += conversation.chars
+        return conversation
+
+    async def get_history(self, key: str) -> List[ChatMessage]:
+        """Recent turns, oldest first, trimmed from the oldest end to the token budget"""
+        if self.max_turns <= 0:
+            return []
+        conversation = await self._get(key)
+        if conversation is None:
+            return []
+
+        history: List[ChatMessage] = []
+        tokens = 0
+        for role, content in reversed(conversation.turns):
+            tokens += len(content) // 4 + 1
+            if tokens > self.token_budget:
+                break
+            history.append(ChatMessage(role=role, content=content))  # type: ignore[arg-type]
+        history.reverse()
+
+        # Start the history on a user turn
+        while history and history[0].role != "user":
+            history.pop(0)
+        return history
+
+    async def add_exchange(self, key: str, message: str, reply: str):
+        """Remember a user message and the reply sent for it"""
+        if self.max_turns <= 0:
+            return
+        conversation = await self._get(key)
+        if conversation is None:
+            conversation = self._conversations[key] = Conversation(self.max_turns)
+
+        before = conversation.chars
+        conversation.append("user", message)
+        conversation.append("assistant", reply)
+        self._chars += conversation.chars - before
+        self._conversations.move_to_end(key)
+        await self._evict()
+
+    def stats(self) -> dict:
+        return {
+            "senders": len(self._conversations),
+            "chars": self._chars,
+            "evicted": self.evicted,
+            "expired": self.expired,
+            "spilled": self.spilled,
+            "restored": self.restored,
+        }
+
+
+# Global conversation memory instance
+conversations = ConversationStore(
+    max_turns=CONVERSATION_MAX_TURNS,
+    token_budget=CONVERSATION_TOKEN_BUDGET,
+    max_senders=CONVERSATION_MAX_SENDERS,
+    max_chars=CONVERSATION_MAX_CHARS,
+    idle_ttl=CONVERSATION_IDLE_TTL,
+    spill_dir=CONVERSATION_SPILL_DIR,
+)
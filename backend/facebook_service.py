@@ -1,39 +1,293 @@
+import asyncio
+import json
+import os
+import random
+import re
+import time
 import httpx
-from typing import Optional
+from collections import deque
+from contextlib import aclosing
+from typing import Deque, Dict, List, Optional, Tuple
 import storage
 from ai_service import ai_service
-from models import WebhookLog
+from conversation import conversations, conversation_key
+from models import ChatMessage, WebhookLog
+from metrics import graph_send_duration, graph_send_errors, messenger_first_message
+from app_logging import get_logger, fields, capped
 from datetime import datetime
 
+logger = get_logger("facebook_service")
+
+# Graph API client settings. GRAPH_API_BASE_URL can point at a local stand-in
+# Graph server for tests and benchmarks.
+GRAPH_API_BASE_URL = os.getenv("GRAPH_API_BASE_URL", "https://graph.facebook.com/v18.0").rstrip("/")
+GRAPH_HTTP2 = os.getenv("GRAPH_HTTP2", "False").lower() == "true"
+GRAPH_MAX_CONNECTIONS = int(os.getenv("GRAPH_MAX_CONNECTIONS", "100"))
+GRAPH_MAX_KEEPALIVE = int(os.getenv("GRAPH_MAX_KEEPALIVE", "20"))
+GRAPH_KEEPALIVE_EXPIRY = float(os.getenv("GRAPH_KEEPALIVE_EXPIRY", "30"))
+GRAPH_TIMEOUT = float(os.getenv("GRAPH_TIMEOUT", "10"))
+GRAPH_CONNECT_TIMEOUT = float(os.getenv("GRAPH_CONNECT_TIMEOUT", "5"))
+
+# Send path: per-page token bucket, retries with jittered exponential backoff
+# and an outbox for sends that still fail afterwards
+GRAPH_SEND_RATE = float(os.getenv("GRAPH_SEND_RATE", "20"))
+GRAPH_SEND_BURST = float(os.getenv("GRAPH_SEND_BURST", "40"))
+GRAPH_SEND_RETRIES = int(os.getenv("GRAPH_SEND_RETRIES", "3"))
+GRAPH_BACKOFF_BASE = float(os.getenv("GRAPH_BACKOFF_BASE", "0.5"))
+GRAPH_BACKOFF_MAX = float(os.getenv("GRAPH_BACKOFF_MAX", "30"))
+GRAPH_USAGE_THRESHOLD = float(os.getenv("GRAPH_USAGE_THRESHOLD", "90"))
+GRAPH_USAGE_PAUSE = float(os.getenv("GRAPH_USAGE_PAUSE", "10"))
+GRAPH_OUTBOX_ENABLED = os.getenv("GRAPH_OUTBOX_ENABLED", "True").lower() == "true"
+GRAPH_OUTBOX_SIZE = int(os.getenv("GRAPH_OUTBOX_SIZE", "1000"))
+GRAPH_OUTBOX_INTERVAL = float(os.getenv("GRAPH_OUTBOX_INTERVAL", "30"))
+GRAPH_OUTBOX_MAX_ATTEMPTS = int(os.getenv("GRAPH_OUTBOX_MAX_ATTEMPTS", "10"))
+
+# Messenger delivery: show a typing indicator from the moment a message is
+# received until the reply is sent and, with streaming on, send the reply in
+# sentence-sized messages as it is generated. A chunk is sent once it ends a sentence and has at least
+# MESSENGER_CHUNK_MIN_CHARS characters, or is cut at a word boundary near
+# MESSENGER_CHUNK_MAX_CHARS (Messenger allows 2000 per message).
+MESSENGER_TYPING_INDICATOR = os.getenv("MESSENGER_TYPING_INDICATOR", "True").lower() == "true"
+MESSENGER_STREAMING = os.getenv("MESSENGER_STREAMING", "False").lower() == "true"
+MESSENGER_CHUNK_MIN_CHARS = int(os.getenv("MESSENGER_CHUNK_MIN_CHARS", "80"))
+MESSENGER_CHUNK_MAX_CHARS = min(int(os.getenv("MESSENGER_CHUNK_MAX_CHARS", "640")), 2000)
+
+# Graph error codes that mean "throttled" even when the status is 400
+GRAPH_RATE_LIMIT_CODES = {4, 17, 32, 613, 80001, 80006}
+
+_graph_client: Optional[httpx.AsyncClient] = None
+
+
+def _http2_available() -> bool:
+    """HTTP/2 needs the optional h2 package (pip install httpx[http2])"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+async def start_graph_client() -> httpx.AsyncClient:
+    """Create the shared Graph API client"""
+    global _graph_client
+    
+    if _graph_client is None or _graph_client.is_closed:
+        http2 = GRAPH_HTTP2 and _http2_available()
+        if GRAPH_HTTP2 and not http2:
+            logger.warning("GRAPH_HTTP2 is set but h2 is not installed, using HTTP/1.1")
+        
+        _graph_client = httpx.AsyncClient(
+            base_url=GRAPH_API_BASE_URL,
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=GRAPH_MAX_CONNECTIONS,
+                max_keepalive_connections=GRAPH_MAX_KEEPALIVE,
+                keepalive_expiry=GRAPH_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(GRAPH_TIMEOUT, connect=GRAPH_CONNECT_TIMEOUT),
+        )
+    
+    return _graph_client
+
+
+async def close_graph_client():
+    """Close the shared Graph API client"""
+    global _graph_client
+    
+    if _graph_client is not None:
+        await _graph_client.aclose()
+        _graph_client = None
+
+
+async def get_graph_client() -> httpx.AsyncClient:
+    """Get the shared Graph API client, creating it if the app lifespan did not"""
+    if _graph_client is None or _graph_client.is_closed:
+        return await start_graph_client()
+    return _graph_client
+
 
 async def test_facebook_connection(page_id: str, access_token: str) -> dict:
     """Test Facebook API connection"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"https://graph.facebook.com/v18.0/{page_id}",
-                params={
-                    "fields": "name,id",
-                    "access_token": access_token
-                }
-            )
-            
-            if response.status_code == 200:
-                return response.json()
-            else:
-                error_data = response.json()
-                raise Exception(f"Facebook API Error: {error_data.get('error', {}).get('message', 'Unknown error')}")
+        client = await get_graph_client()
+        response = await client.get(
+            f"/{page_id}",
+            params={
+                "fields": "name,id",
+                "access_token": access_token
+            }
+        )
+        
+        if response.status_code == 200:
+            return response.json()
+        else:
+            error_data = response.json()
+            raise Exception(f"Facebook API Error: {error_data.get('error', {}).get('message', 'Unknown error')}")
     
     except Exception as e:
         raise Exception(f"Failed to connect to Facebook: {str(e)}")
 
 
-async def send_facebook_message(recipient_id: str, message_text: str, access_token: str) -> dict:
-    """Send a message via Facebook Messenger"""
+class GraphAPIError(Exception):
+    """Graph API request failure"""
+    
+    def __init__(self, message: str, status_code: Optional[int] = None, code: Optional[int] = None, retryable: bool = False):
+        super().__init__(message)
+        self.status_code = status_code
+        self.code = code
+        self.retryable = retryable
+
+
+class TokenBucket:
+    """Token bucket rate limiter that can also be paused for a while"""
+    
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+    
+    def pause(self, seconds: float):
+        """Stop handing out tokens for the given time"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+    
+    def try_acquire(self) -> bool:
+        """Take a token if one is available right now"""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return False
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+    
+    def paused_for(self) -> float:
+        """Seconds left of the current pause"""
+        return max(0.0, self.paused_until - time.monotonic())
+    
+    async def acquire(self, max_pause: Optional[float] = None) -> bool:
+        """Wait until a token is available and take it.
+
+        Returns False right away if the bucket is paused for longer than max_pause.
+        """
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                if max_pause is not None and self.paused_until - now > max_pause:
+                    return False
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class _OutboxEntry:
+    __slots__ = ("recipient_id", "message_text", "access_token", "page_id", "attempts")
+    
+    def __init__(self, recipient_id: str, message_text: str, access_token: str, page_id: Optional[str]):
+        self.recipient_id = recipient_id
+        self.message_text = message_text
+        self.access_token = access_token
+        self.page_id = page_id
+        self.attempts = 0
+
+
+_buckets: Dict[str, TokenBucket] = {}
+_outbox: Deque[_OutboxEntry] = deque()
+_outbox_task: Optional[asyncio.Task] = None
+send_stats = {"sent": 0, "retries": 0, "failed": 0, "queued": 0, "dropped": 0, "throttled": 0, "deferred": 0}
+
+
+def _bucket_for(page_id: Optional[str], access_token: str) -> TokenBucket:
+    key = page_id or access_token
+    bucket = _buckets.get(key)
+    if bucket is None:
+        bucket = _buckets[key] = TokenBucket(GRAPH_SEND_RATE, GRAPH_SEND_BURST)
+    return bucket
+
+
+def _usage_pause(response: httpx.Response) -> float:
+    """Seconds to hold off sending based on Graph's rate limit usage headers"""
+    usages = []
+    regain_minutes = 0.0
+    
+    for header in ("x-app-usage", "x-page-usage", "x-business-use-case-usage"):
+        raw = response.headers.get(header)
+        if not raw:
+            continue
+        try:
+            data = json.loads(raw)
+        except ValueError:
+            continue
+        
+        # x-business-use-case-usage is {business_id: [usage, ...]}
+        entries = [usage for values in data.values() for usage in values] if header == "x-business-use-case-usage" else [data]
+        for usage in entries:
+            if not isinstance(usage, dict):
+                continue
+            usages.extend(float(usage.get(field) or 0) for field in ("call_count", "total_time", "total_cputime"))
+            regain_minutes = max(regain_minutes, float(usage.get("estimated_time_to_regain_access") or 0))
+    
+    if regain_minutes > 0:
+        return regain_minutes * 60
+    if usages and max(usages) >= GRAPH_USAGE_THRESHOLD:
+        return GRAPH_USAGE_PAUSE
+    return 0.0
+
+
+def _backoff_delay(attempt: int, response: Optional[httpx.Response] = None) -> float:
+    """Jittered exponential backoff, or the server's Retry-After if it sent one"""
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        if retry_after:
+            try:
+                return min(float(retry_after), GRAPH_BACKOFF_MAX)
+            except ValueError:
+                pass
+    return random.uniform(0, min(GRAPH_BACKOFF_MAX, GRAPH_BACKOFF_BASE * 2 ** attempt))
+
+
+def _response_error(response: httpx.Response) -> GraphAPIError:
     try:
-        async with httpx.AsyncClient() as client:
+        error = response.json().get("error", {})
+    except ValueError:
+        error = {}
+    
+    code = error.get("code")
+    retryable = response.status_code == 429 or response.status_code >= 500 or code in GRAPH_RATE_LIMIT_CODES
+    return GraphAPIError(
+        f"Failed to send message: {error.get('message') or response.text or f'HTTP {response.status_code}'}",
+        status_code=response.status_code,
+        code=code,
+        retryable=retryable
+    )
+
+
+async def send_facebook_message(recipient_id: str, message_text: str, access_token: str, page_id: Optional[str] = None) -> dict:
+    """Send a message via Facebook Messenger, rate limited per page and retried on throttling or server errors"""
+    bucket = _bucket_for(page_id, access_token)
+    client = await get_graph_client()
+    
+    attempt = 0
+    while True:
+        # A long usage pause would hold the webhook worker for minutes, leave it to the outbox
+        if not await bucket.acquire(max_pause=GRAPH_BACKOFF_MAX):
+            send_stats["deferred"] += 1
+            raise GraphAPIError(f"Page is rate limited for another {bucket.paused_for():.0f}s", retryable=True)
+        
+        response: Optional[httpx.Response] = None
+        started = time.perf_counter()
+        try:
             response = await client.post(
-                f"https://graph.facebook.com/v18.0/me/messages",
+                "/me/messages",
                 params={"access_token": access_token},
                 json={
                     "recipient": {"id": recipient_id},
@@ -41,25 +295,289 @@ async def send_facebook_message(recipient_id: str, message_text: str, access_tok
                 }
             )
             
+            pause = _usage_pause(response)
+            if pause > 0:
+                send_stats["throttled"] += 1
+                bucket.pause(pause)
+            
             if response.status_code == 200:
+                graph_send_duration.observe(time.perf_counter() - started, "ok")
+                send_stats["sent"] += 1
                 return response.json()
-            else:
-                error_data = response.json()
-                raise Exception(f"Failed to send message: {error_data}")
+            error = _response_error(response)
+            graph_send_duration.observe(time.perf_counter() - started, "error")
+        
+        except httpx.TransportError as e:
+            error = GraphAPIError(f"Failed to send message: {e}", retryable=True)
+            graph_send_duration.observe(time.perf_counter() - started, "transport_error")
+        
+        graph_send_errors.inc(1, str(error.status_code or "none"), str(error.code or "none"))
+        
+        if not error.retryable or attempt >= GRAPH_SEND_RETRIES:
+            send_stats["failed"] += 1
+            logger.error("Error sending Facebook message", extra=fields(
+                recipientId=recipient_id, status=error.status_code, code=error.code, error=str(error)
+            ))
+            raise error
+        
+        delay = _backoff_delay(attempt, response)
+        attempt += 1
+        send_stats["retries"] += 1
+        logger.warning("Retrying Facebook send", extra=fields(delay=round(delay, 2), error=str(error)))
+        await asyncio.sleep(delay)
+
+
+async def send_sender_action(recipient_id: str, action: str, access_token: str, page_id: Optional[str] = None) -> bool:
+    """Best-effort sender action such as typing_on.
+
+    Never waits for the rate limiter or retries, since a late indicator is
+    useless; returns whether it was sent.
+    """
+    if not _bucket_for(page_id, access_token).try_acquire():
+        return False
     
-    except Exception as e:
-        print(f"Error sending Facebook message: {e}")
-        raise
+    client = await get_graph_client()
+    try:
+        response = await client.post(
+            "/me/messages",
+            params={"access_token": access_token},
+            json={
+                "recipient": {"id": recipient_id},
+                "sender_action": action
+            }
+        )
+    except httpx.TransportError as e:
+        logger.debug("Sender action failed", extra=fields(action=action, error=str(e)))
+        return False
+    
+    if response.status_code != 200:
+        logger.debug("Sender action failed", extra=fields(action=action, status=response.status_code))
+        return False
+    return True
+
+
+# typing_on sends started when a message was accepted, by conversation key
+_typing_tasks: Dict[str, asyncio.Task] = {}
+
+
+def start_typing(recipient_id: str, access_token: str, page_id: Optional[str] = None):
+    """Show the typing indicator as soon as a message is accepted.
+
+    The send is kept until handle_facebook_message picks the message up, so the
+    reply never goes out before the indicator.
+    """
+    key = conversation_key(page_id, recipient_id)
+    if not MESSENGER_TYPING_INDICATOR or key in _typing_tasks:
+        return
+    _typing_tasks[key] = asyncio.get_running_loop().create_task(
+        send_sender_action(recipient_id, "typing_on", access_token, page_id)
+    )
+
+
+_SENTENCE_END = re.compile(r'[.!?…。！？]+["\')\]]*(?=\s)|\n')
+
+
+class SentenceChunker:
+    """Groups streamed text into sentence-sized messages"""
+    
+    def __init__(self, min_chars: int = 80, max_chars: int = 640):
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.buffer = ""
+    
+    def feed(self, text: str) -> List[str]:
+        """Add streamed text, returning the chunks that are ready to send"""
+        self.buffer += text
+        chunks = []
+        while True:
+            cut = self._cut()
+            if cut is None:
+                return chunks
+            chunk, self.buffer = self.buffer[:cut].strip(), self.buffer[cut:].lstrip()
+            if chunk:
+                chunks.append(chunk)
+    
+    def flush(self) -> Optional[str]:
+        """Whatever is left once the stream ends"""
+        chunk, self.buffer = self.buffer.strip(), ""
+        return chunk or None
+    
+    def _cut(self) -> Optional[int]:
+        # Last sentence end that keeps the chunk within max_chars
+        cut = None
+        for match in _SENTENCE_END.finditer(self.buffer):
+            if match.end() > self.max_chars:
+                break
+            if match.end() >= self.min_chars:
+                cut = match.end()
+        if cut is not None:
+            return cut
+        
+        if len(self.buffer) <= self.max_chars:
+            return None
+        # No sentence end in reach: cut at the last space, or hard at max_chars
+        space = self.buffer.rfind(" ", 0, self.max_chars)
+        return space if space > 0 else self.max_chars
+
+
+async def _deliver_streamed(
+    sender_id: str,
+    message_text: str,
+    history: List[ChatMessage],
+    access_token: str,
+    page_id: Optional[str],
+    typing: Optional[asyncio.Task],
+    started: float
+) -> Tuple[str, str]:
+    """Send the reply in chunks as it streams, returning (reply, status)"""
+    chunks: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+    undelivered: List[str] = []
+    failure: List[GraphAPIError] = []
+    
+    async def send_chunks():
+        if typing is not None:
+            await typing
+        first = True
+        while True:
+            chunk = await chunks.get()
+            if chunk is None:
+                return
+            # After a failed send keep the rest together so it stays in order
+            if failure:
+                undelivered.append(chunk)
+                continue
+            try:
+                await send_facebook_message(sender_id, chunk, access_token, page_id)
+            except GraphAPIError as e:
+                failure.append(e)
+                undelivered.append(chunk)
+                continue
+            if first:
+                messenger_first_message.observe(time.perf_counter() - started, "streamed")
+                first = False
+    
+    sender = asyncio.create_task(send_chunks())
+    chunker = SentenceChunker(MESSENGER_CHUNK_MIN_CHARS, MESSENGER_CHUNK_MAX_CHARS)
+    parts: List[str] = []
+    try:
+        stream = ai_service.stream_message_reply(message_text, history, priority="customer", page_id=page_id)
+        async with aclosing(stream):
+            async for content in stream:
+                parts.append(content)
+                for chunk in chunker.feed(content):
+                    chunks.put_nowait(chunk)
+        rest = chunker.flush()
+        if rest:
+            chunks.put_nowait(rest)
+    finally:
+        chunks.put_nowait(None)
+        await sender
+    
+    reply = "".join(parts).strip()
+    if not failure:
+        return reply, "sent"
+    
+    error = failure[0]
+    if error.retryable and queue_outbox(sender_id, "\n".join(undelivered), access_token, page_id):
+        return reply, "queued"
+    raise error
+
+
+def queue_outbox(recipient_id: str, message_text: str, access_token: str, page_id: Optional[str] = None) -> bool:
+    """Keep a failed send for later, returns False if the outbox is disabled or full"""
+    if not GRAPH_OUTBOX_ENABLED:
+        return False
+    if len(_outbox) >= GRAPH_OUTBOX_SIZE:
+        send_stats["dropped"] += 1
+        return False
+    
+    _outbox.append(_OutboxEntry(recipient_id, message_text, access_token, page_id))
+    send_stats["queued"] += 1
+    start_outbox()
+    return True
 
 
-async def handle_facebook_message(sender_id: str, message_text: str, access_token: str):
+async def flush_outbox():
+    """Retry every message currently in the outbox once"""
+    for _ in range(len(_outbox)):
+        entry = _outbox.popleft()
+        if _bucket_for(entry.page_id, entry.access_token).paused_for() > GRAPH_BACKOFF_MAX:
+            # Still throttled, which does not count as an attempt
+            _outbox.append(entry)
+            continue
+        entry.attempts += 1
+        try:
+            await send_facebook_message(entry.recipient_id, entry.message_text, entry.access_token, entry.page_id)
+        except GraphAPIError as e:
+            if e.retryable and entry.attempts < GRAPH_OUTBOX_MAX_ATTEMPTS:
+                _outbox.append(entry)
+            else:
+                send_stats["dropped"] += 1
+                logger.error("Dropping outbox message", extra=fields(
+                    recipientId=entry.recipient_id, attempts=entry.attempts, error=str(e)
+                ))
+
+
+async def _run_outbox():
+    while True:
+        await asyncio.sleep(GRAPH_OUTBOX_INTERVAL)
+        try:
+            await flush_outbox()
+        except Exception as e:
+            logger.error("Error flushing outbox", extra=fields(error=str(e)))
+
+
+def start_outbox():
+    """Start the background outbox retry task"""
+    global _outbox_task
+    if GRAPH_OUTBOX_ENABLED and (_outbox_task is None or _outbox_task.done()):
+        _outbox_task = asyncio.get_running_loop().create_task(_run_outbox())
+
+
+async def stop_outbox():
+    """Stop the background outbox retry task"""
+    global _outbox_task
+    if _outbox_task is not None:
+        _outbox_task.cancel()
+        try:
+            await _outbox_task
+        except asyncio.CancelledError:
+            pass
+        _outbox_task = None
+
+
+def get_send_stats() -> dict:
+    """Graph send counters and outbox size"""
+    return {**send_stats, "outbox": len(_outbox)}
+
+
+async def handle_facebook_message(sender_id: str, message_text: str, access_token: str, page_id: Optional[str] = None):
     """Handle incoming Facebook message and send AI reply"""
+    started = time.perf_counter()
+    key = conversation_key(page_id, sender_id)
+    typing = _typing_tasks.pop(key, None)
     try:
-        # Generate AI reply
-        reply = await ai_service.generate_reply(message_text)
+        # Generate AI reply, continuing the sender's conversation
+        history = await conversations.get_history(key)
+        
+        if MESSENGER_STREAMING:
+            reply, status = await _deliver_streamed(sender_id, message_text, history, access_token, page_id, typing, started)
+        else:
+            reply = await ai_service.generate_reply(message_text, history, priority="customer", page_id=page_id)
+            if typing is not None:
+                await typing
+            
+            # Send reply, keeping it in the outbox if Graph stays unavailable
+            status = "sent"
+            try:
+                await send_facebook_message(sender_id, reply, access_token, page_id)
+                messenger_first_message.observe(time.perf_counter() - started, "whole")
+            except GraphAPIError as e:
+                if not e.retryable or not queue_outbox(sender_id, reply, access_token, page_id):
+                    raise
+                status = "queued"
         
-        # Send reply
-        await send_facebook_message(sender_id, reply, access_token)
+        await conversations.add_exchange(key, message_text, reply)
         
         # Log the interaction
         await storage.save_webhook_log(WebhookLog(
@@ -68,11 +586,12 @@ async def handle_facebook_message(sender_id: str, message_text: str, access_toke
             data={
                 "senderId": sender_id,
                 "message": message_text,
-                "reply": reply
+                "reply": reply,
+                "status": status
             }
         ))
         
-        print(f"Replied to {sender_id}: {reply}")
+        logger.info("Replied", extra=fields(senderId=sender_id, status=status, reply=capped(reply)))
     
     except Exception as e:
-        print(f"Error handling Facebook message: {e}")
+        logger.error("Error handling Facebook message", extra=fields(senderId=sender_id, error=str(e)))
@@ -0,0 +1,104 @@
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Generic, Iterable, List, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+def write_atomic(path: str, chunks: Iterable[bytes]):
+    """Write a file through a temporary file, fsync it and rename it into place"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class GroupCommitWriter(Generic[T]):
+    """Single writer for one file that batches concurrent mutations.
+
+    Callers submit a mutation function taking the current state and returning
+    (new state, result). Mutations queued within the batching window are
+    applied in order and written with one atomic file replacement; each
+    caller's result is returned once that write is durable. A mutation that
+    raises only fails its own caller.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        load: Callable[[], Awaitable[T]],
+        serialize: Callable[[T], bytes],
+        on_commit: Callable[[T], None],
+        window: float = 0.005,
+    ):
+        self.path = path
+        self.load = load
+        self.serialize = serialize
+        self.on_commit = on_commit
+        self.window = window
+        self._pending: List[Tuple[Callable[[T], Tuple[T, Any]], asyncio.Future]] = []
+        self._task: Optional[asyncio.Task] = None
+
+        self.batches = 0
+        self.mutations = 0
+
+    async def submit(self, mutate: Callable[[T], Tuple[T, Any]]) -> Any:
+        """Queue a mutation and wait until it has been written"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((mutate, future))
+
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+        return await future
+
+    async def _run(self):
+        while self._pending:
+            # Let concurrent callers join this batch
+            await asyncio.sleep(self.window)
+            batch, self._pending = self._pending, []
+
+            try:
+                state = await self.load()
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            applied = []
+            for mutate, future in batch:
+                try:
+                    state, result = mutate(state)
+                    applied.append((future, result))
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+
+            if not applied:
+                continue
+
+            try:
+                await asyncio.to_thread(lambda: write_atomic(self.path, [self.serialize(state)]))
+                self.on_commit(state)
+            except Exception as e:
+                for future, _ in applied:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.mutations += len(applied)
+            for future, result in applied:
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "mutations": self.mutations,
+            "avgBatchSize": round(self.mutations / self.batches, 2) if self.batches else 0.0,
+        }
@@ -0,0 +1,230 @@
+import asyncio
+import json
+import os
+import re
+import time
+import aiofiles
+from typing import AsyncIterator, Dict, Iterable, List, Optional
+from group_commit import write_atomic
+
+_SEGMENT_RE = re.compile(r"^(\d{8})\.jsonl$")
+
+
+def _count_lines(path: str) -> int:
+    count = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            count += block.count(b"\n")
+    return count
+
+
+class JsonlLog:
+    """Append-only record log stored as numbered JSONL segments.
+
+    Appends only touch the newest (active) segment. Reads go newest-first by
+    scanning segments from the end. maintain() rotates the active segment by
+    size or age, merges small sealed segments and drops the oldest segments
+    beyond max_records.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_segment_bytes: int = 1 << 20,
+        max_segment_age: float = 86400.0,
+        max_records: int = 0,
+    ):
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_age = max_segment_age
+        self.max_records = max_records
+        self._segments: Optional[List[int]] = None
+        self._line_counts: Dict[int, int] = {}
+        self._active_since: Optional[float] = None
+
+    def _path(self, seq: int) -> str:
+        return os.path.join(self.directory, f"{seq:08d}.jsonl")
+
+    def _load_segments(self) -> List[int]:
+        if self._segments is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._segments = sorted(
+                int(match.group(1))
+                for match in map(_SEGMENT_RE.match, os.listdir(self.directory))
+                if match
+            )
+            if not self._segments:
+                self._segments.append(1)
+        return self._segments
+
+    def is_empty(self) -> bool:
+        segments = self._load_segments()
+        return all(not os.path.exists(self._path(seq)) or os.path.getsize(self._path(seq)) == 0 for seq in segments)
+
+    async def append(self, record: dict):
+        """Append one record to the active segment"""
+        seq = self._load_segments()[-1]
+        if self._active_since is None:
+            self._active_since = time.time()
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        async with aiofiles.open(self._path(seq), "a", encoding="utf-8") as f:
+            await f.write(line)
+
+    async def _reversed_lines(self, path: str, block_size: int = 1 << 16) -> AsyncIterator[bytes]:
+        try:
+            f = await aiofiles.open(path, "rb")
+        except FileNotFoundError:
+            # Removed by maintenance while we were reading
+            return
+
+        try:
+            pos = await f.seek(0, os.SEEK_END)
+            remainder = b""
+            while pos > 0:
+                size = min(block_size, pos)
+                pos -= size
+                await f.seek(pos)
+                lines = (await f.read(size) + remainder).split(b"\n")
+                remainder = lines.pop(0)
+                for line in reversed(lines):
+                    if line.strip():
+                        yield line
+            if remainder.strip():
+                yield remainder
+        finally:
+            await f.close()
+
+    async def iter_newest(self) -> AsyncIterator[dict]:
+        """Yield records newest-first"""
+        for seq in reversed(list(self._load_segments())):
+            async for line in self._reversed_lines(self._path(seq)):
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Torn write at the end of a segment
+                    continue
+
+    async def iter_newest_after(self, key: str, value: str) -> AsyncIterator[dict]:
+        """Yield records newest-first, starting after the first with record[key] == value.
+
+        Skipped records are not parsed: only lines containing the serialized
+        key/value pair are checked, so paging costs a byte scan up to the cursor.
+        """
+        needle = f"{json.dumps(key)}: {json.dumps(value, ensure_ascii=False)}".encode("utf-8")
+        skipping = True
+        for seq in reversed(list(self._load_segments())):
+            async for line in self._reversed_lines(self._path(seq)):
+                if skipping and needle not in line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if skipping:
+                    skipping = record.get(key) != value
+                    continue
+                yield record
+
+    async def read_newest(self, limit: Optional[int] = None) -> List[dict]:
+        """Get up to limit records, newest-first"""
+        records: List[dict] = []
+        if limit is not None and limit <= 0:
+            return records
+        async for record in self.iter_newest():
+            records.append(record)
+            if limit is not None and len(records) >= limit:
+                break
+        return records
+
+    async def rewrite(self, records_oldest_first: Iterable[dict]):
+        """Replace the whole log with the given records"""
+        segments = self._load_segments()
+        old_segments = list(segments)
+
+        # Appends made while we write go to the segment after the new one
+        seq = segments[-1] + 1
+        segments.append(seq + 1)
+        self._active_since = None
+
+        lines = ((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8") for record in records_oldest_first)
+        await asyncio.to_thread(write_atomic, self._path(seq), lines)
+
+        self._segments = [seq, seq + 1]
+        self._line_counts.clear()
+        for old in old_segments:
+            try:
+                os.remove(self._path(old))
+            except FileNotFoundError:
+                pass
+
+    def _rotate_if_needed(self):
+        segments = self._load_segments()
+        path = self._path(segments[-1])
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return
+        started = self._active_since or stat.st_mtime
+        if stat.st_size >= self.max_segment_bytes or (stat.st_size and time.time() - started >= self.max_segment_age):
+            segments.append(segments[-1] + 1)
+            self._active_since = None
+
+    def _compact_sealed(self):
+        """Merge neighbouring small sealed segments and apply retention"""
+        segments = self._load_segments()
+        sealed = segments[:-1]
+
+        # Merge runs of sealed segments that fit in one segment together
+        i = 0
+        while i < len(sealed) - 1:
+            first, second = sealed[i], sealed[i + 1]
+            first_path, second_path = self._path(first), self._path(second)
+            if not os.path.exists(first_path) or not os.path.exists(second_path):
+                i += 1
+                continue
+            if os.path.getsize(first_path) + os.path.getsize(second_path) > self.max_segment_bytes:
+                i += 1
+                continue
+
+            def chunks():
+                for path in (first_path, second_path):
+                    with open(path, "rb") as f:
+                        yield f.read()
+
+            write_atomic(second_path, chunks())
+            os.remove(first_path)
+            if first in self._line_counts and second in self._line_counts:
+                self._line_counts[second] += self._line_counts[first]
+            else:
+                self._line_counts.pop(second, None)
+            self._line_counts.pop(first, None)
+            segments.remove(first)
+            sealed.pop(i)
+
+        # Drop whole old segments while the rest still holds max_records
+        if self.max_records > 0:
+            counts = {}
+            for seq in segments:
+                if seq not in self._line_counts:
+                    path = self._path(seq)
+                    count = _count_lines(path) if os.path.exists(path) else 0
+                    if seq == segments[-1]:
+                        counts[seq] = count
+                        continue
+                    self._line_counts[seq] = count
+                counts[seq] = self._line_counts[seq]
+
+            total = sum(counts.values())
+            while len(segments) > 1 and total - counts[segments[0]] >= self.max_records:
+                oldest = segments.pop(0)
+                total -= counts[oldest]
+                self._line_counts.pop(oldest, None)
+                try:
+                    os.remove(self._path(oldest))
+                except FileNotFoundError:
+                    pass
+
+    async def maintain(self):
+        """Rotate, compact and trim segments"""
+        self._rotate_if_needed()
+        await asyncio.to_thread(self._compact_sealed)
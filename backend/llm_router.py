@@ -0,0 +1,482 @@
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from typing import Any, AsyncContextManager, AsyncIterator, Awaitable, Callable, Deque, List, Optional, Set, TypeVar
+from openai import AsyncOpenAI, BadRequestError
+from metrics import llm_request_duration
+from app_logging import get_logger, fields
+
+logger = get_logger("llm_router")
+
+T = TypeVar("T")
+
+# Admission for one upstream request, called with the seconds left until the
+# call's deadline (e.g. a concurrency limiter slot)
+Slot = Callable[[Optional[float]], AsyncContextManager[Any]]
+
+# Extra OpenAI-compatible backends as a JSON list of
+# {"name", "baseUrl", "apiKey", "model"}, tried after GITHUB_TOKEN / OPENAI_API_KEY.
+# Requests go to the first healthy backend in this order; latency only picks
+# which of the others to hedge or fail over to.
+LLM_BACKENDS = os.getenv("LLM_BACKENDS", "")
+
+# Hedging: when a request is slower than the backend's LLM_HEDGE_QUANTILE
+# latency (clamped to the min/max delay; the default delay until enough
+# samples exist), a second request goes to the next backend and the loser is
+# cancelled. A lone backend is never hedged against itself. Rolling latency
+# and error stats cover the last LLM_STATS_WINDOW calls.
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "True").lower() == "true"
+LLM_HEDGE_QUANTILE = float(os.getenv("LLM_HEDGE_QUANTILE", "0.95"))
+LLM_HEDGE_MIN_DELAY_MS = float(os.getenv("LLM_HEDGE_MIN_DELAY_MS", "250"))
+LLM_HEDGE_MAX_DELAY_MS = float(os.getenv("LLM_HEDGE_MAX_DELAY_MS", "10000"))
+LLM_HEDGE_DEFAULT_DELAY_MS = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY_MS", "3000"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_STATS_WINDOW = int(os.getenv("LLM_STATS_WINDOW", "100"))
+
+# Timeout of a single HTTP request to a backend (seconds)
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "30"))
+
+# Circuit breaker: a backend failing LLM_BREAKER_FAILURES times in a row is
+# skipped for LLM_BREAKER_COOLDOWN seconds, then tried again with one probe
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+
+class CircuitOpenError(Exception):
+    """Raised when every LLM backend's circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker counting consecutive failures"""
+
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.opens = 0
+        self._probing = False
+
+    def allow(self) -> bool:
+        """Whether a request may go out now; in half-open state only one probe at a time"""
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probing:
+                return False
+            self._probing = True
+        return True
+
+    def success(self):
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self._probing = False
+
+    def failure(self):
+        self.consecutive_failures += 1
+        self._probing = False
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+            if self.state != "open":
+                self.opens += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        """A request ended without a verdict on the backend's health"""
+        self._probing = False
+
+
+class LLMBackend:
+    """One OpenAI-compatible endpoint with rolling latency and error stats"""
+
+    def __init__(
+        self,
+        name: str,
+        client: AsyncOpenAI,
+        model: str,
+        window: int = 100,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.breaker = breaker or CircuitBreaker()
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self._outcomes: Deque[bool] = deque(maxlen=window)
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.cancelled = 0
+
+    def record(self, ok: bool, latency: float, trip: bool = True):
+        """Record an outcome; trip=False keeps errors caused by the request itself off the breaker"""
+        self._outcomes.append(ok)
+        if ok:
+            self._latencies.append(latency)
+            self.breaker.success()
+            return
+        self.errors += 1
+        if trip:
+            self.breaker.failure()
+        else:
+            self.breaker.release()
+
+    def record_cancelled(self, elapsed: float):
+        """A cancelled request took at least elapsed, keep that as a latency sample"""
+        self.cancelled += 1
+        self._latencies.append(elapsed)
+        self.breaker.release()
+
+    @property
+    def error_rate(self) -> float:
+        return self._outcomes.count(False) / len(self._outcomes) if self._outcomes else 0.0
+
+    def latency_quantile(self, q: float) -> Optional[float]:
+        if not self._latencies:
+            return None
+        samples = sorted(self._latencies)
+        return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+    def stats(self) -> dict:
+        p50 = self.latency_quantile(0.5)
+        p95 = self.latency_quantile(0.95)
+        return {
+            "name": self.name,
+            "model": self.model,
+            "circuit": self.breaker.state,
+            "circuitOpens": self.breaker.opens,
+            "requests": self.requests,
+            "errors": self.errors,
+            "cancelled": self.cancelled,
+            "inFlight": self.in_flight,
+            "errorRate": round(self.error_rate, 4),
+            "p50Ms": round(p50 * 1000, 1) if p50 is not None else None,
+            "p95Ms": round(p95 * 1000, 1) if p95 is not None else None,
+        }
+
+
+def _remaining(deadline: Optional[float]) -> Optional[float]:
+    return None if deadline is None else max(deadline - time.monotonic(), 0.0)
+
+
+class LLMRouter:
+    """Routes chat completions across backends with hedged requests, failover and circuit breakers"""
+
+    def __init__(
+        self,
+        backends: List[LLMBackend],
+        hedge: bool = True,
+        hedge_quantile: float = 0.95,
+        hedge_min_delay: float = 0.25,
+        hedge_max_delay: float = 10.0,
+        hedge_default_delay: float = 3.0,
+        hedge_min_samples: int = 20,
+    ):
+        self.backends = backends
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_delay = hedge_max_delay
+        self.hedge_default_delay = hedge_default_delay
+        self.hedge_min_samples = hedge_min_samples
+
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+        self.timeouts = 0
+        self.rejected = 0
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.backends)
+
+    def ordered(self) -> List[LLMBackend]:
+        """The backend to try first, then hedge / failover targets.
+
+        The first choice follows the configured order, skipping backends with a
+        higher error rate (in 10% steps). Only the backups behind it are ranked
+        by median latency, so a faster but different model never takes over
+        traffic from the preferred one just by being faster.
+        """
+        by_health = sorted(self.backends, key=lambda backend: round(backend.error_rate, 1))
+        
+        def backup_score(backend: LLMBackend):
+            p50 = backend.latency_quantile(0.5)
+            return (round(backend.error_rate, 1), p50 if p50 is not None else 0.0)
+        return by_health[:1] + sorted(by_health[1:], key=backup_score)
+
+    def hedge_delay(self, backend: LLMBackend) -> float:
+        if len(backend._latencies) < self.hedge_min_samples:
+            return self.hedge_default_delay
+        delay = backend.latency_quantile(self.hedge_quantile) or self.hedge_default_delay
+        return min(max(delay, self.hedge_min_delay), self.hedge_max_delay)
+
+    async def _attempt(
+        self,
+        backend: LLMBackend,
+        call: Callable[[LLMBackend], Awaitable[T]],
+        deadline: Optional[float],
+        slot: Optional[Slot] = None,
+        trip: bool = True,
+    ) -> T:
+        # Waiting for a slot is not the backend's latency
+        if slot is not None:
+            async with slot(_remaining(deadline)):
+                return await self._attempt(backend, call, deadline, trip=trip)
+
+        started = time.perf_counter()
+        backend.requests += 1
+        backend.in_flight += 1
+        try:
+            result = await asyncio.wait_for(call(backend), _remaining(deadline))
+        except asyncio.CancelledError:
+            backend.record_cancelled(time.perf_counter() - started)
+            llm_request_duration.observe(time.perf_counter() - started, backend.name, "cancelled")
+            raise
+        except Exception as e:
+            backend.record(False, time.perf_counter() - started, trip=trip and not isinstance(e, BadRequestError))
+            outcome = "timeout" if isinstance(e, asyncio.TimeoutError) else "error"
+            llm_request_duration.observe(time.perf_counter() - started, backend.name, outcome)
+            logger.warning("LLM backend failed", extra=fields(backend=backend.name, error=str(e) or outcome))
+            raise
+        finally:
+            backend.in_flight -= 1
+        latency = time.perf_counter() - started
+        backend.record(True, latency)
+        llm_request_duration.observe(latency, backend.name, "ok")
+        return result
+
+    async def call(
+        self,
+        call: Callable[[LLMBackend], Awaitable[T]],
+        timeout: Optional[float] = None,
+        slot: Optional[Slot] = None,
+    ) -> T:
+        """Run call on the best backend, hedging slow requests and failing over on errors.
+
+        Every attempt ends by the deadline (raising asyncio.TimeoutError) and,
+        hedges included, holds its own slot while it runs.
+        CircuitOpenError is raised at once when no backend's breaker lets a request through.
+        """
+        if not self.backends:
+            raise RuntimeError("No LLM backend configured")
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        # A single backend still gets one retry on error, but is never hedged
+        # against itself: that only doubles the cost of a slow call
+        candidates = self.ordered()
+        if len(candidates) == 1:
+            candidates = candidates * 2
+
+        pending: Set[asyncio.Task] = set()
+        backends_of = {}
+        attempted: Set[LLMBackend] = set()
+        last_error: Optional[BaseException] = None
+        next_index = 0
+
+        def launch() -> Optional[asyncio.Task]:
+            nonlocal next_index
+            while next_index < len(candidates):
+                backend = candidates[next_index]
+                next_index += 1
+                if not backend.breaker.allow():
+                    continue
+                # A backend's breaker counts one failure per call, not per retry
+                task = asyncio.ensure_future(self._attempt(backend, call, deadline, slot, trip=backend not in attempted))
+                attempted.add(backend)
+                # Losers are cancelled without being awaited, don't warn about their errors
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+                backends_of[task] = backend
+                pending.add(task)
+                return task
+            return None
+
+        primary = launch()
+        if primary is None:
+            self.rejected += 1
+            raise CircuitOpenError("All LLM backends are unavailable")
+
+        try:
+            while pending:
+                can_hedge = (
+                    self.hedge and next_index < len(candidates) and len(pending) == 1 and primary in pending
+                    and candidates[next_index] is not backends_of[primary]
+                )
+                wait = self.hedge_delay(backends_of[primary]) if can_hedge else None
+                done, _ = await asyncio.wait(pending, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    # Primary is slower than usual, race it against a hedge
+                    if launch() is not None:
+                        self.hedges += 1
+                    continue
+
+                for task in done:
+                    pending.discard(task)
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.hedge_wins += 1
+                        return task.result()
+                    last_error = task.exception()
+
+                if not pending and _remaining(deadline) != 0.0:
+                    failover = launch()
+                    if failover is not None:
+                        self.failovers += 1
+                        primary = failover
+
+            if isinstance(last_error, asyncio.TimeoutError):
+                self.timeouts += 1
+            assert last_error is not None
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def complete(
+        self,
+        messages: List[Any],
+        timeout: Optional[float] = None,
+        slot: Optional[Slot] = None,
+        **kwargs: Any
+    ) -> Any:
+        """Chat completion through the router, within timeout seconds"""
+        return await self.call(lambda backend: backend.client.chat.completions.create(
+            model=backend.model, messages=messages, **kwargs
+        ), timeout, slot)
+
+    async def stream(
+        self,
+        messages: List[Any],
+        first_token_timeout: Optional[float] = None,
+        idle_timeout: Optional[float] = None,
+        **kwargs: Any
+    ) -> AsyncIterator[str]:
+        """Streamed chat completion; fails over to the next backend until the first token arrives.
+
+        The upstream stream is closed when the consumer stops early, e.g. on a
+        client disconnect, so close this generator (aclosing) rather than drop it.
+        """
+        if not self.backends:
+            raise RuntimeError("No LLM backend configured")
+
+        last_error: Optional[Exception] = None
+        for backend in self.ordered():
+            if not backend.breaker.allow():
+                continue
+
+            started = time.perf_counter()
+            deadline = time.monotonic() + first_token_timeout if first_token_timeout is not None else None
+            backend.requests += 1
+            backend.in_flight += 1
+            received = False
+            stream = None
+            try:
+                stream = await asyncio.wait_for(
+                    backend.client.chat.completions.create(model=backend.model, messages=messages, stream=True, **kwargs),
+                    _remaining(deadline)
+                )
+                chunks = stream.__aiter__()
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(
+                            chunks.__anext__(), idle_timeout if received else _remaining(deadline)
+                        )
+                    except StopAsyncIteration:
+                        break
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if not received:
+                            received = True
+                            backend.record(True, time.perf_counter() - started)
+                        yield chunk.choices[0].delta.content
+                if not received:
+                    backend.record(True, time.perf_counter() - started)
+                llm_request_duration.observe(time.perf_counter() - started, backend.name, "ok")
+                return
+            except (asyncio.CancelledError, GeneratorExit):
+                if not received:
+                    backend.record_cancelled(time.perf_counter() - started)
+                llm_request_duration.observe(time.perf_counter() - started, backend.name, "cancelled")
+                raise
+            except Exception as e:
+                outcome = "timeout" if isinstance(e, asyncio.TimeoutError) else "error"
+                llm_request_duration.observe(time.perf_counter() - started, backend.name, outcome)
+                if outcome == "timeout":
+                    self.timeouts += 1
+                if received:
+                    raise
+                backend.record(False, time.perf_counter() - started, trip=not isinstance(e, BadRequestError))
+                logger.warning("LLM backend failed", extra=fields(backend=backend.name, error=str(e) or outcome))
+                last_error = e
+                self.failovers += 1
+            finally:
+                backend.in_flight -= 1
+                if stream is not None:
+                    await stream.close()
+
+        if last_error is None:
+            self.rejected += 1
+            raise CircuitOpenError("All LLM backends are unavailable")
+        raise last_error
+
+    def stats(self) -> dict:
+        return {
+            "hedges": self.hedges,
+            "hedgeWins": self.hedge_wins,
+            "failovers": self.failovers,
+            "timeouts": self.timeouts,
+            "rejected": self.rejected,
+            "backends": [backend.stats() for backend in self.backends],
+        }
+
+
+def backends_from_env() -> List[LLMBackend]:
+    """GitHub Models and OpenAI from their tokens, plus any LLM_BACKENDS entries"""
+    specs = []
+    github_token = os.getenv("GITHUB_TOKEN")
+    openai_key = os.getenv("OPENAI_API_KEY")
+    if github_token:
+        specs.append({"name": "github", "apiKey": github_token,
+                      "baseUrl": "https://models.inference.ai.azure.com", "model": "gpt-4o"})
+    if openai_key:
+        specs.append({"name": "openai", "apiKey": openai_key, "model": "gpt-3.5-turbo"})
+    if LLM_BACKENDS:
+        try:
+            specs.extend(json.loads(LLM_BACKENDS))
+        except ValueError as e:
+            logger.error("Invalid LLM_BACKENDS, ignoring it", extra=fields(error=str(e)))
+
+    # With several backends a failing one is left to the router instead of client retries
+    client_retries = {"max_retries": 0} if len(specs) > 1 else {}
+    return [
+        LLMBackend(
+            spec.get("name") or f"backend{i}",
+            AsyncOpenAI(
+                api_key=spec.get("apiKey") or "none",
+                base_url=spec.get("baseUrl"),
+                timeout=LLM_REQUEST_TIMEOUT,
+                **client_retries
+            ),
+            spec.get("model") or "gpt-3.5-turbo",
+            window=LLM_STATS_WINDOW,
+            breaker=CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_COOLDOWN),
+        )
+        for i, spec in enumerate(specs)
+    ]
+
+
+def router_from_env() -> LLMRouter:
+    return LLMRouter(
+        backends_from_env(),
+        hedge=LLM_HEDGE_ENABLED,
+        hedge_quantile=LLM_HEDGE_QUANTILE,
+        hedge_min_delay=LLM_HEDGE_MIN_DELAY_MS / 1000,
+        hedge_max_delay=LLM_HEDGE_MAX_DELAY_MS / 1000,
+        hedge_default_delay=LLM_HEDGE_DEFAULT_DELAY_MS / 1000,
+        hedge_min_samples=LLM_HEDGE_MIN_SAMPLES,
+    )
@@ -1,28 +1,62 @@
+import logging
 import os
+import time
+from contextlib import aclosing, asynccontextmanager
 from fastapi import FastAPI, HTTPException, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse, PlainTextResponse
 from dotenv import load_dotenv
 from datetime import datetime
-import time
+from typing import AsyncIterator, Literal, Optional
+from pydantic import BaseModel
+
+# Load environment variables before the services read their configuration
+load_dotenv()
+
+from app_logging import setup_logging, shutdown_logging, get_logger, fields, capped, should_sample
+setup_logging()
+logger = get_logger("main")
 
 from models import (
     TrainingDataCreate, TrainingDataUpdate, TrainingDataItem,
     ReplyRequest, ReplyResponse, SentReplyCreate, SentReplyItem,
-    FacebookConfig, StatsResponse, ChatRequest, WebhookLog
+    FacebookConfig, StatsResponse, ChatRequest, WebhookLog, MessagingEvent
 )
 import storage
+import bulk_import
+import stats
+import metrics
 from ai_service import ai_service
-from facebook_service import test_facebook_connection, handle_facebook_message
+from facebook_service import (
+    test_facebook_connection,
+    start_graph_client, close_graph_client, start_outbox, stop_outbox, get_send_stats
+)
+from conversation import conversations
+from webhook_queue import webhook_dispatcher, recent_event_ids, event_id, QueueFullError
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create shared clients on startup and close them on shutdown"""
+    setup_logging()
+    await start_graph_client()
+    storage.start_log_maintenance()
+    start_outbox()
+    webhook_dispatcher.start()
+    yield
+    await webhook_dispatcher.stop()
+    await stop_outbox()
+    await storage.stop_log_maintenance()
+    await close_graph_client()
+    shutdown_logging()
 
-# Load environment variables
-load_dotenv()
 
 # Create FastAPI app
 app = FastAPI(
     title="FB Reply AI Backend",
     description="Python backend for AI-powered Facebook reply system",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Configure CORS
@@ -36,21 +70,66 @@ app.add_middleware(
 )
 
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Record request latency per route template"""
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        metrics.http_request_duration.observe(
+            time.perf_counter() - started,
+            request.method,
+            getattr(route, "path", "unmatched"),
+            str(status)
+        )
+
+
+# Pagination helpers
+async def paginate(rows: AsyncIterator[BaseModel], limit: Optional[int]) -> dict:
+    """Collect one page of rows; without a limit every row is returned"""
+    data = []
+    next_cursor = None
+    
+    async for row in rows:
+        if limit is not None and len(data) >= limit:
+            next_cursor = getattr(data[-1], "id")
+            break
+        data.append(row)
+    
+    return {"data": data, "nextCursor": next_cursor}
+
+
+def ndjson_response(rows: AsyncIterator[BaseModel], limit: Optional[int]) -> StreamingResponse:
+    """Stream rows as newline-delimited JSON as they are read"""
+    async def stream():
+        count = 0
+        async for row in rows:
+            if limit is not None and count >= limit:
+                break
+            yield row.model_dump_json() + "\n"
+            count += 1
+    
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
 # Training endpoints
 @app.post("/api/train")
 async def add_training_data(data: TrainingDataCreate):
     """Add new training data"""
-    training_data = await storage.get_training_data()
-    
     new_entry = TrainingDataItem(
-        id=str(int(time.time() * 1000)),
+        id=storage.new_id(),
         message=data.message.strip(),
         reply=data.reply.strip(),
-        timestamp=datetime.utcnow().isoformat()
+        timestamp=datetime.utcnow().isoformat(),
+        pageId=data.pageId or None
     )
     
-    training_data.append(new_entry)
-    await storage.save_training_data(training_data)
+    await storage.add_training_item(new_entry)
     
     return {
         "success": True,
@@ -60,45 +139,99 @@ async def add_training_data(data: TrainingDataCreate):
 
 
 @app.get("/api/training-data")
-async def get_training_data():
-    """Get all training data"""
-    data = await storage.get_training_data()
-    return {"data": data}
+async def get_training_data(
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    q: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    page_id: Optional[str] = Query(None, alias="pageId"),
+    format: Literal["json", "ndjson"] = "json"
+):
+    """Get training data, optionally paginated, filtered or streamed as NDJSON"""
+    rows = storage.iter_training_data(query=q, since=since, until=until, after=cursor, page_id=page_id)
+    if format == "ndjson":
+        return ndjson_response(rows, limit)
+    return await paginate(rows, limit)
+
+
+@app.post("/api/train/bulk")
+async def bulk_add_training_data(
+    request: Request,
+    format: Optional[Literal["ndjson", "csv"]] = None,
+    dedupe: bool = True,
+    page_id: Optional[str] = Query(None, alias="pageId")
+):
+    """Import training data from a streamed NDJSON or CSV upload (message/reply/pageId fields)"""
+    if format is None:
+        content_type = request.headers.get("content-type", "")
+        format = "csv" if "csv" in content_type else "ndjson"
+    
+    import_id = request.headers.get("x-import-id") or storage.new_id()
+    if format == "csv":
+        rows = bulk_import.iter_csv_rows(request.stream())
+    else:
+        rows = bulk_import.iter_ndjson_rows(request.stream())
+    
+    progress = await bulk_import.import_training_data(rows, import_id, dedupe=dedupe, page_id=page_id)
+    return {"success": True, **progress}
+
+
+@app.get("/api/train/bulk/{import_id}")
+async def get_bulk_import_progress(import_id: str):
+    """Get the progress of a bulk import"""
+    progress = bulk_import.get_import_progress(import_id)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Import not found")
+    return progress
+
+
+@app.get("/api/train/export")
+async def export_training_data(format: Literal["ndjson", "csv"] = "ndjson"):
+    """Stream all training data as NDJSON or CSV"""
+    _, data = await storage.get_training_snapshot()
+    
+    if format == "csv":
+        content = bulk_import.export_csv(data)
+        media_type = "text/csv"
+    else:
+        content = bulk_import.export_ndjson(data)
+        media_type = "application/x-ndjson"
+    
+    return StreamingResponse(
+        content,
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename=training-data.{format}"}
+    )
 
 
 @app.put("/api/training-data")
 async def update_training_data(data: TrainingDataUpdate):
     """Update training data"""
-    training_data = await storage.get_training_data()
+    updated_entry = TrainingDataItem(
+        id=data.id,
+        message=data.message.strip(),
+        reply=data.reply.strip(),
+        timestamp=datetime.utcnow().isoformat(),
+        pageId=data.pageId or None
+    )
     
-    for i, item in enumerate(training_data):
-        if item.id == data.id:
-            training_data[i] = TrainingDataItem(
-                id=data.id,
-                message=data.message.strip(),
-                reply=data.reply.strip(),
-                timestamp=datetime.utcnow().isoformat()
-            )
-            await storage.save_training_data(training_data)
-            return {
-                "success": True,
-                "message": "Training data updated successfully",
-                "data": training_data[i]
-            }
+    if not await storage.update_training_item(updated_entry):
+        raise HTTPException(status_code=404, detail="Training data not found")
     
-    raise HTTPException(status_code=404, detail="Training data not found")
+    return {
+        "success": True,
+        "message": "Training data updated successfully",
+        "data": updated_entry
+    }
 
 
 @app.delete("/api/training-data")
 async def delete_training_data(id: str = Query(...)):
     """Delete training data"""
-    training_data = await storage.get_training_data()
-    filtered_data = [item for item in training_data if item.id != id]
-    
-    if len(filtered_data) == len(training_data):
+    if not await storage.delete_training_item(id):
         raise HTTPException(status_code=404, detail="Training data not found")
     
-    await storage.save_training_data(filtered_data)
     return {"success": True, "message": "Training data deleted successfully"}
 
 
@@ -109,16 +242,20 @@ async def generate_reply(request: ReplyRequest):
     if not request.message.strip():
         raise HTTPException(status_code=400, detail="Message is required")
     
-    reply = await ai_service.generate_reply(request.message)
+    reply = await ai_service.generate_reply(request.message, page_id=request.pageId)
     return ReplyResponse(reply=reply)
 
 
 @app.post("/api/chat")
-async def generate_chat_reply(request: ChatRequest):
+async def generate_chat_reply(request: ChatRequest, http_request: Request):
     """Generate AI reply (streaming)"""
     async def stream_response():
-        async for chunk in ai_service.generate_reply_stream(request.messages):
-            yield chunk
+        # Stop (and close the upstream stream) as soon as the client goes away
+        async with aclosing(ai_service.generate_reply_stream(request.messages, page_id=request.pageId)) as chunks:
+            async for chunk in chunks:
+                if await http_request.is_disconnected():
+                    break
+                yield chunk
     
     return StreamingResponse(stream_response(), media_type="text/plain")
 
@@ -127,18 +264,15 @@ async def generate_chat_reply(request: ChatRequest):
 @app.post("/api/send-reply")
 async def send_reply(data: SentReplyCreate):
     """Send custom reply"""
-    sent_replies = await storage.get_sent_replies()
-    
     new_entry = SentReplyItem(
-        id=str(int(time.time() * 1000)),
+        id=storage.new_id(),
         message=data.message.strip(),
         reply=data.reply.strip(),
         mode=data.mode,
         timestamp=datetime.utcnow().isoformat()
     )
     
-    sent_replies.insert(0, new_entry)
-    await storage.save_sent_replies(sent_replies)
+    await storage.add_sent_reply(new_entry)
     
     return {
         "success": True,
@@ -148,37 +282,66 @@ async def send_reply(data: SentReplyCreate):
 
 
 @app.get("/api/send-reply")
-async def get_sent_replies():
-    """Get sent replies history"""
-    data = await storage.get_sent_replies()
-    return {"data": data}
+async def get_sent_replies(
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    q: Optional[str] = None,
+    mode: Optional[Literal["ai", "manual"]] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    format: Literal["json", "ndjson"] = "json"
+):
+    """Get sent replies history (newest first), optionally paginated, filtered or streamed as NDJSON"""
+    rows = storage.iter_sent_replies(mode=mode, query=q, since=since, until=until, after=cursor)
+    if format == "ndjson":
+        return ndjson_response(rows, limit)
+    return await paginate(rows, limit)
 
 
 # Facebook Integration endpoints
 @app.get("/api/facebook/config")
-async def get_facebook_config():
-    """Get Facebook configuration"""
-    config = await storage.get_facebook_config()
+async def get_facebook_config(page_id: Optional[str] = Query(None, alias="pageId")):
+    """Get a page's Facebook configuration (the last added page without pageId)"""
+    config = await storage.get_facebook_config(page_id)
     return {"config": config}
 
 
+@app.get("/api/facebook/configs")
+async def get_facebook_configs():
+    """Get every page's Facebook configuration"""
+    return {"configs": await storage.get_facebook_configs()}
+
+
 @app.post("/api/facebook/config")
-async def save_facebook_config(config: FacebookConfig):
-    """Save Facebook configuration"""
+async def save_facebook_config(config: FacebookConfig, add: bool = False):
+    """Add or update a page's Facebook configuration.
+
+    While only one page is configured a new Page ID replaces it unless add is
+    set, so the single-page settings form can correct a wrong Page ID.
+    """
     if not config.pageId or not config.accessToken or not config.verifyToken:
         raise HTTPException(
             status_code=400,
             detail="Page ID, Access Token, and Verify Token are required"
         )
     
-    await storage.save_facebook_config(config)
+    await storage.save_facebook_config(config, replace_single=not add)
     return {"success": True, "message": "Configuration saved successfully"}
 
 
+@app.delete("/api/facebook/config/{page_id}")
+async def delete_facebook_config(page_id: str):
+    """Remove a page's Facebook configuration"""
+    if not await storage.delete_facebook_config(page_id):
+        raise HTTPException(status_code=404, detail="Page configuration not found")
+    
+    return {"success": True, "message": "Configuration deleted successfully"}
+
+
 @app.post("/api/facebook/test")
-async def test_facebook_webhook():
-    """Test Facebook connection"""
-    config = await storage.get_facebook_config()
+async def test_facebook_webhook(page_id: Optional[str] = Query(None, alias="pageId")):
+    """Test a page's Facebook connection (the last added page without pageId)"""
+    config = await storage.get_facebook_config(page_id)
     
     if not config or not config.pageId or not config.accessToken:
         raise HTTPException(
@@ -206,16 +369,16 @@ async def verify_facebook_webhook(
     hub_challenge: str = Query(None, alias="hub.challenge")
 ):
     """Facebook webhook verification"""
-    print(f"Webhook verification: mode={hub_mode}, token={hub_verify_token}")
+    logger.info("Webhook verification", extra=fields(mode=hub_mode))
     
     if hub_mode == "subscribe":
-        config = await storage.get_facebook_config()
+        configs = await storage.get_facebook_configs()
         
-        if config and hub_verify_token == config.verifyToken:
-            print("Webhook verified successfully")
+        if hub_verify_token and any(hub_verify_token == config.verifyToken for config in configs):
+            logger.info("Webhook verified successfully")
             return PlainTextResponse(content=hub_challenge)
         else:
-            print("Verification failed: token mismatch")
+            logger.warning("Webhook verification failed: token mismatch")
             raise HTTPException(status_code=403, detail="Verification token mismatch")
     
     raise HTTPException(status_code=400, detail="Invalid verification request")
@@ -225,7 +388,9 @@ async def verify_facebook_webhook(
 async def handle_facebook_webhook(request: Request):
     """Handle Facebook webhook events"""
     body = await request.json()
-    print(f"Webhook received: {body}")
+    # Payload dumps are sampled (all of them at DEBUG) and size-capped
+    if logger.isEnabledFor(logging.DEBUG) or (logger.isEnabledFor(logging.INFO) and should_sample()):
+        logger.info("Webhook received", extra=fields(payload=capped(body)))
     
     # Log webhook event
     await storage.save_webhook_log(WebhookLog(
@@ -235,46 +400,94 @@ async def handle_facebook_webhook(request: Request):
     ))
     
     if body.get("object") == "page":
+        # Route each entry to its page's config from the in-memory index
+        configs = await storage.get_facebook_config_index()
+        events = []
+        event_ids = []
+        
         for entry in body.get("entry", []):
+            config = configs.get(entry.get("id"))
+            if config is None:
+                # A single configured page answers everything, as before multi-page support
+                fallback = next(iter(configs.values())) if len(configs) == 1 else None
+                logger.warning("Webhook entry for unknown page", extra=fields(
+                    pageId=entry.get("id"), fallbackPageId=fallback.pageId if fallback else None
+                ))
+                config = fallback
             for event in entry.get("messaging", []):
+                # Drop events Facebook already delivered
+                key = event_id(event)
+                if key is not None:
+                    if recent_event_ids.seen(key) or key in event_ids:
+                        continue
+                    event_ids.append(key)
+                
                 # Handle message
                 if "message" in event and not event["message"].get("is_echo"):
-                    sender_id = event["sender"]["id"]
                     message_text = event["message"].get("text", "")
                     
-                    if message_text:
-                        config = await storage.get_facebook_config()
-                        if config and config.accessToken:
-                            await handle_facebook_message(
-                                sender_id,
-                                message_text,
-                                config.accessToken
-                            )
+                    if message_text and config and config.accessToken:
+                        events.append(MessagingEvent(
+                            senderId=event["sender"]["id"],
+                            text=message_text,
+                            accessToken=config.accessToken,
+                            pageId=config.pageId,
+                            mid=event["message"].get("mid")
+                        ))
+        
+        # Replies are generated and sent by the webhook workers
+        try:
+            webhook_dispatcher.submit(events)
+        except QueueFullError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        
+        # Only remember ids once accepted, a rejected batch must stay retryable
+        for key in event_ids:
+            recent_event_ids.add(key)
     
     return {"status": "ok"}
 
 
+@app.get("/api/webhook/stats")
+async def get_webhook_stats():
+    """Get webhook queue statistics"""
+    return {
+        **webhook_dispatcher.stats(),
+        "duplicatesSuppressed": recent_event_ids.duplicates,
+        "send": get_send_stats(),
+        "conversations": conversations.stats()
+    }
+
+
 # Statistics endpoint
 @app.get("/api/stats", response_model=StatsResponse)
 async def get_stats():
     """Get system statistics"""
-    training_data = await storage.get_training_data()
-    
-    last_updated = "Never"
-    if training_data:
-        last_item = training_data[-1]
-        try:
-            dt = datetime.fromisoformat(last_item.timestamp)
-            last_updated = dt.strftime("%Y-%m-%d")
-        except:
-            last_updated = "Unknown"
+    total_training, last_updated = await storage.get_training_summary()
+    sent_reply_counts = await storage.get_sent_reply_counts()
     
     return StatsResponse(
-        totalTrainingData=len(training_data),
-        lastUpdated=last_updated
+        totalTrainingData=total_training,
+        lastUpdated=last_updated,
+        totalSentReplies=sum(sent_reply_counts.values()),
+        sentRepliesByMode=sent_reply_counts,
+        **stats.get_counters()
     )
 
 
+@app.get("/api/ai/stats")
+async def get_ai_stats():
+    """Get prompt cache and retrieval statistics"""
+    return ai_service.get_stats()
+
+
+# Metrics
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics"""
+    return PlainTextResponse(metrics.render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 # Health check endpoint
 @app.get("/")
 async def root():
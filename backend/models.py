@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional, List, Literal
+from typing import Dict, Optional, List, Literal
 from datetime import datetime
 
 
@@ -8,21 +8,25 @@ class TrainingDataItem(BaseModel):
     message: str
     reply: str
     timestamp: str
+    pageId: Optional[str] = None  # None: shared by all pages
 
 
 class TrainingDataCreate(BaseModel):
     message: str
     reply: str
+    pageId: Optional[str] = None
 
 
 class TrainingDataUpdate(BaseModel):
     id: str
     message: str
     reply: str
+    pageId: Optional[str] = None
 
 
 class ReplyRequest(BaseModel):
     message: str
+    pageId: Optional[str] = None
 
 
 class ReplyResponse(BaseModel):
@@ -58,9 +62,24 @@ class WebhookLog(BaseModel):
     data: dict
 
 
+class MessagingEvent(BaseModel):
+    senderId: str
+    text: str
+    accessToken: str
+    pageId: Optional[str] = None
+    mid: Optional[str] = None
+
+
 class StatsResponse(BaseModel):
     totalTrainingData: int
     lastUpdated: str
+    totalSentReplies: int = 0
+    sentRepliesByMode: Dict[str, int] = {}
+    repliesGenerated: int = 0
+    fallbackReplies: int = 0
+    webhookEventsProcessed: int = 0
+    replyLatencyMs: Dict[str, float] = {}
+    throughputPerMinute: Dict[str, Dict[str, float]] = {}
 
 
 class ChatMessage(BaseModel):
@@ -70,3 +89,4 @@ class ChatMessage(BaseModel):
 
 class ChatRequest(BaseModel):
     messages: List[ChatMessage]
+    pageId: Optional[str] = None
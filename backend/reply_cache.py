@@ -0,0 +1,180 @@
+import random
+import time
+import zlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+from retrieval import normalize_text
+
+_MERSENNE_PRIME = (1 << 61) - 1
+
+
+class _Entry:
+    __slots__ = ("reply", "expires_at", "signature")
+
+    def __init__(self, reply: str, expires_at: float, signature: Optional[Tuple[int, ...]]):
+        self.reply = reply
+        self.expires_at = expires_at
+        self.signature = signature
+
+
+class ReplyCache:
+    """Bounded LRU/TTL cache of generated replies.
+
+    Keys are a scope (the page's training data view) plus the normalized
+    message text, and the cache only holds replies for one training data
+    version; it is cleared as soon as another version is seen.
+    With fuzzy matching on, near-duplicate messages are found through MinHash
+    signatures of character 3-grams bucketed with LSH.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 1000,
+        ttl: float = 3600.0,
+        fuzzy: bool = False,
+        fuzzy_threshold: float = 0.85,
+        num_perm: int = 32,
+        bands: int = 8,
+        seed: int = 1,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.fuzzy = fuzzy
+        self.fuzzy_threshold = fuzzy_threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.version: Optional[int] = None
+
+        self._entries: "OrderedDict[Tuple[str, str], _Entry]" = OrderedDict()
+        self._buckets: Dict[Tuple[int, Tuple[int, ...]], Set[Tuple[str, str]]] = {}
+        # Random (a, b) pairs mod the prime so each hash orders shingles differently;
+        # seeded so signatures are stable across restarts
+        rng = random.Random(seed)
+        self._perms = [
+            (rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+            for _ in range(self.bands * self.rows)
+        ]
+
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _signature(self, key: str) -> Tuple[int, ...]:
+        """MinHash signature over character 3-grams"""
+        padded = f" {key} "
+        shingles = {zlib.crc32(padded[i:i + 3].encode("utf-8")) for i in range(max(len(padded) - 2, 1))}
+        return tuple(
+            min((a * shingle + b) % _MERSENNE_PRIME for shingle in shingles)
+            for a, b in self._perms
+        )
+
+    def _bands_of(self, signature: Tuple[int, ...]) -> List[Tuple[int, Tuple[int, ...]]]:
+        return [(band, signature[band * self.rows:(band + 1) * self.rows]) for band in range(self.bands)]
+
+    def _remove(self, key: Tuple[str, str]):
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry.signature is not None:
+            for band in self._bands_of(entry.signature):
+                bucket = self._buckets.get(band)
+                if bucket is not None:
+                    bucket.discard(key)
+                    if not bucket:
+                        del self._buckets[band]
+
+    def _check_version(self, version: int):
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    def _near_match(self, scope: str, signature: Tuple[int, ...], now: float) -> Optional[Tuple[str, str]]:
+        candidates: Set[Tuple[str, str]] = set()
+        for band in self._bands_of(signature):
+            candidates.update(self._buckets.get(band, ()))
+
+        best_key, best_score = None, 0.0
+        for candidate in candidates:
+            if candidate[0] != scope:
+                continue
+            entry = self._entries[candidate]
+            if entry.expires_at <= now or entry.signature is None:
+                continue
+            score = sum(1 for x, y in zip(signature, entry.signature) if x == y) / len(signature)
+            if score > best_score:
+                best_key, best_score = candidate, score
+
+        return best_key if best_score >= self.fuzzy_threshold else None
+
+    def get(self, message: str, version: int, scope: str = "") -> Optional[str]:
+        """Return a cached reply for the message, or None"""
+        if self.max_size <= 0:
+            return None
+        self._check_version(version)
+
+        text = normalize_text(message)
+        if not text:
+            return None
+        key = (scope, text)
+
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at <= now:
+            self._remove(key)
+            entry = None
+
+        if entry is None and self.fuzzy and self._buckets:
+            near_key = self._near_match(scope, self._signature(text), now)
+            if near_key is not None:
+                self.near_hits += 1
+                key, entry = near_key, self._entries[near_key]
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry.reply
+
+    def put(self, message: str, version: int, reply: str, scope: str = ""):
+        """Cache a reply for the message"""
+        if self.max_size <= 0:
+            return
+        self._check_version(version)
+
+        text = normalize_text(message)
+        if not text:
+            return
+        key = (scope, text)
+
+        self._remove(key)
+        signature = self._signature(text) if self.fuzzy else None
+        self._entries[key] = _Entry(reply, time.monotonic() + self.ttl, signature)
+        if signature is not None:
+            for band in self._bands_of(signature):
+                self._buckets.setdefault(band, set()).add(key)
+
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def clear(self):
+        """Drop all cached replies"""
+        self._entries.clear()
+        self._buckets.clear()
+
+    def stats(self) -> dict:
+        """Cache size and hit/miss/eviction counters"""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxSize": self.max_size,
+            "hits": self.hits,
+            "nearHits": self.near_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hitRate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
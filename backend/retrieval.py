@@ -0,0 +1,162 @@
+import heapq
+import math
+import re
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+from models import TrainingDataItem
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into lowercase word tokens"""
+    return _TOKEN_RE.findall(text.lower())
+
+
+def normalize_text(text: str) -> str:
+    """Normalize text for matching (lowercase, punctuation and extra spaces removed)"""
+    return " ".join(tokenize(text))
+
+
+class BM25Index:
+    """BM25 index over training data messages, maintained incrementally"""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.version: Optional[int] = None
+        self._items: Dict[str, TrainingDataItem] = {}
+        self._doc_lengths: Dict[str, int] = {}
+        self._postings: Dict[str, Dict[str, int]] = {}
+        self._exact: Dict[str, List[str]] = {}
+        self._total_length = 0
+
+        # Retrieval latency
+        self.searches = 0
+        self.total_search_ms = 0.0
+        self.last_search_ms = 0.0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def add(self, item: TrainingDataItem):
+        """Add or replace a training item"""
+        if item.id in self._items:
+            self.remove(item.id)
+
+        term_freqs = Counter(tokenize(item.message))
+        for term, count in term_freqs.items():
+            self._postings.setdefault(term, {})[item.id] = count
+
+        self._exact.setdefault(normalize_text(item.message), []).append(item.id)
+
+        length = sum(term_freqs.values())
+        self._items[item.id] = item
+        self._doc_lengths[item.id] = length
+        self._total_length += length
+
+    def remove(self, item_id: str) -> bool:
+        """Remove a training item, returns False if it was not indexed"""
+        item = self._items.pop(item_id, None)
+        if item is None:
+            return False
+
+        for term in set(tokenize(item.message)):
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(item_id, None)
+                if not postings:
+                    del self._postings[term]
+
+        key = normalize_text(item.message)
+        ids = self._exact.get(key)
+        if ids is not None:
+            ids.remove(item_id)
+            if not ids:
+                del self._exact[key]
+
+        self._total_length -= self._doc_lengths.pop(item_id)
+        return True
+
+    def sync(self, version: int, items: List[TrainingDataItem]):
+        """Bring the index up to date with a training data snapshot.
+
+        Only items whose message changed are re-indexed, so a single
+        add/update/delete costs one document's worth of work.
+        """
+        if version == self.version:
+            return
+
+        seen = set()
+        for item in items:
+            seen.add(item.id)
+            current = self._items.get(item.id)
+            if current is None or current.message != item.message:
+                self.add(item)
+            elif current is not item:
+                self._items[item.id] = item
+
+        for item_id in [item_id for item_id in self._items if item_id not in seen]:
+            self.remove(item_id)
+
+        self.version = version
+
+    def search(self, query: str, k: int) -> List[Tuple[TrainingDataItem, float]]:
+        """Return up to k (item, score) pairs most relevant to the query"""
+        start = time.perf_counter()
+
+        scores: Dict[str, float] = {}
+        doc_count = len(self._items)
+        if doc_count and k > 0:
+            avg_length = self._total_length / doc_count or 1.0
+            for term in set(tokenize(query)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+
+                idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for item_id, freq in postings.items():
+                    norm = 1 - self.b + self.b * self._doc_lengths[item_id] / avg_length
+                    scores[item_id] = scores.get(item_id, 0.0) + idf * freq * (self.k1 + 1) / (freq + self.k1 * norm)
+
+        top = heapq.nlargest(k, scores.items(), key=lambda pair: pair[1])
+
+        self.last_search_ms = (time.perf_counter() - start) * 1000
+        self.total_search_ms += self.last_search_ms
+        self.searches += 1
+
+        return [(self._items[item_id], score) for item_id, score in top]
+
+    def best_match(self, query: str, candidates: int = 10) -> Optional[Tuple[TrainingDataItem, float]]:
+        """Find the training item whose message best matches the query.
+
+        An exact match of the normalized text scores 1.0, otherwise the score
+        is the token-set (Jaccard) similarity of the best BM25 candidates.
+        """
+        key = normalize_text(query)
+        ids = self._exact.get(key)
+        if ids:
+            return self._items[ids[-1]], 1.0
+
+        query_tokens = set(key.split())
+        if not query_tokens:
+            return None
+
+        best: Optional[Tuple[TrainingDataItem, float]] = None
+        for item, _ in self.search(key, candidates):
+            item_tokens = set(tokenize(item.message))
+            score = len(query_tokens & item_tokens) / len(query_tokens | item_tokens)
+            if best is None or score > best[1]:
+                best = (item, score)
+        return best
+
+    def stats(self) -> dict:
+        """Index size and retrieval latency"""
+        return {
+            "documents": len(self._items),
+            "terms": len(self._postings),
+            "searches": self.searches,
+            "lastSearchMs": round(self.last_search_ms, 3),
+            "avgSearchMs": round(self.total_search_ms / self.searches, 3) if self.searches else 0.0,
+        }
@@ -0,0 +1,309 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from models import TrainingDataItem, SentReplyItem, FacebookConfig, WebhookLog
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS training_data (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    message TEXT NOT NULL,
+    reply TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    page_id TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_training_data_timestamp ON training_data(timestamp);
+
+CREATE TABLE IF NOT EXISTS sent_replies (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL,
+    message TEXT NOT NULL,
+    reply TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sent_replies_timestamp ON sent_replies(timestamp);
+CREATE INDEX IF NOT EXISTS idx_sent_replies_mode ON sent_replies(mode, timestamp);
+
+CREATE TABLE IF NOT EXISTS webhook_logs (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT NOT NULL,
+    type TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_webhook_logs_type ON webhook_logs(type, timestamp);
+
+CREATE TABLE IF NOT EXISTS facebook_config (
+    page_id TEXT PRIMARY KEY,
+    page_name TEXT,
+    access_token TEXT NOT NULL,
+    verify_token TEXT NOT NULL,
+    webhook_url TEXT,
+    is_connected INTEGER NOT NULL DEFAULT 0,
+    seq INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+_TRAINING_COLUMNS = "id, message, reply, timestamp, page_id"
+_SENT_REPLY_COLUMNS = "id, message, reply, mode, timestamp"
+
+
+def _training_item(row: tuple) -> TrainingDataItem:
+    return TrainingDataItem(id=row[0], message=row[1], reply=row[2], timestamp=row[3], pageId=row[4])
+
+
+def _sent_reply(row: tuple) -> SentReplyItem:
+    return SentReplyItem(id=row[0], message=row[1], reply=row[2], mode=row[3], timestamp=row[4])
+
+
+def _facebook_config(row: tuple) -> FacebookConfig:
+    return FacebookConfig(
+        pageId=row[0],
+        pageName=row[1] or "",
+        accessToken=row[2],
+        verifyToken=row[3],
+        webhookUrl=row[4] or "",
+        isConnected=bool(row[5])
+    )
+
+
+class SqliteStore:
+    """SQLite (WAL mode) storage backend.
+
+    A single connection is shared behind a lock and every call runs in a
+    worker thread so the event loop never blocks on disk.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self.created = False
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.created = not os.path.exists(self.path)
+
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            # Databases created before per-page training data lack page_id
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(training_data)")}
+            if "page_id" not in columns:
+                conn.execute("ALTER TABLE training_data ADD COLUMN page_id TEXT")
+            self._conn = conn
+        return self._conn
+
+    def _call(self, fn: Callable[..., Any], *args: Any) -> Any:
+        with self._lock:
+            return fn(self._connection(), *args)
+
+    async def _run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        return await asyncio.to_thread(self._call, fn, *args)
+
+    async def open(self) -> bool:
+        """Open the database, returns True if it was just created"""
+        await self._run(lambda conn: None)
+        return self.created
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    async def data_version(self) -> int:
+        """Changes whenever another connection commits to the database"""
+        return await self._run(lambda conn: conn.execute("PRAGMA data_version").fetchone()[0])
+
+    # Training data
+    async def get_training_data(self) -> List[TrainingDataItem]:
+        def query(conn):
+            rows = conn.execute(f"SELECT {_TRAINING_COLUMNS} FROM training_data ORDER BY seq").fetchall()
+            return [_training_item(row) for row in rows]
+        return await self._run(query)
+
+    async def add_training_items(self, items: List[TrainingDataItem]):
+        def insert(conn):
+            with conn:
+                conn.executemany(
+                    "INSERT INTO training_data (id, message, reply, timestamp, page_id) VALUES (?, ?, ?, ?, ?)",
+                    [(item.id, item.message, item.reply, item.timestamp, item.pageId) for item in items]
+                )
+        await self._run(insert)
+
+    async def update_training_item(self, item: TrainingDataItem) -> bool:
+        def update(conn):
+            with conn:
+                cursor = conn.execute(
+                    "UPDATE training_data SET message = ?, reply = ?, timestamp = ?, page_id = ? WHERE id = ?",
+                    (item.message, item.reply, item.timestamp, item.pageId, item.id)
+                )
+            return cursor.rowcount > 0
+        return await self._run(update)
+
+    async def delete_training_item(self, item_id: str) -> bool:
+        def delete(conn):
+            with conn:
+                cursor = conn.execute("DELETE FROM training_data WHERE id = ?", (item_id,))
+            return cursor.rowcount > 0
+        return await self._run(delete)
+
+    async def replace_training_data(self, items: List[TrainingDataItem]):
+        def replace(conn):
+            with conn:
+                conn.execute("DELETE FROM training_data")
+                conn.executemany(
+                    "INSERT INTO training_data (id, message, reply, timestamp, page_id) VALUES (?, ?, ?, ?, ?)",
+                    [(item.id, item.message, item.reply, item.timestamp, item.pageId) for item in items]
+                )
+        await self._run(replace)
+
+    # Sent replies
+    async def get_sent_replies_page(
+        self,
+        before_seq: Optional[int],
+        limit: int,
+        mode: Optional[str] = None,
+        query: Optional[str] = None,
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+    ) -> List[Tuple[int, SentReplyItem]]:
+        """Get up to limit matching (seq, reply) pairs older than before_seq, newest first"""
+        conditions = []
+        params: List[Any] = []
+        if before_seq is not None:
+            conditions.append("seq < ?")
+            params.append(before_seq)
+        if mode:
+            conditions.append("mode = ?")
+            params.append(mode)
+        if since:
+            conditions.append("timestamp >= ?")
+            params.append(since)
+        if until:
+            # Prefix comparison so a plain date includes the whole day
+            conditions.append("substr(timestamp, 1, ?) <= ?")
+            params.extend([len(until), until])
+        if query:
+            pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            conditions.append("(message LIKE ? ESCAPE '\\' OR reply LIKE ? ESCAPE '\\')")
+            params.extend([pattern, pattern])
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        params.append(limit)
+
+        def select(conn):
+            rows = conn.execute(
+                f"SELECT seq, {_SENT_REPLY_COLUMNS} FROM sent_replies {where} ORDER BY seq DESC LIMIT ?",
+                params
+            ).fetchall()
+            return [(row[0], _sent_reply(row[1:])) for row in rows]
+        return await self._run(select)
+
+    async def sent_reply_seq(self, item_id: str) -> Optional[int]:
+        """Get the position of a sent reply, used as a pagination cursor"""
+        def select(conn):
+            row = conn.execute(
+                "SELECT seq FROM sent_replies WHERE id = ? ORDER BY seq DESC LIMIT 1",
+                (item_id,)
+            ).fetchone()
+            return row[0] if row else None
+        return await self._run(select)
+
+    async def count_sent_replies_by_mode(self) -> Dict[str, int]:
+        def count(conn):
+            return dict(conn.execute("SELECT mode, COUNT(*) FROM sent_replies GROUP BY mode").fetchall())
+        return await self._run(count)
+
+    async def add_sent_replies(self, items_oldest_first: Iterable[SentReplyItem]):
+        rows = [(item.id, item.message, item.reply, item.mode, item.timestamp) for item in items_oldest_first]
+
+        def insert(conn):
+            with conn:
+                conn.executemany(
+                    "INSERT INTO sent_replies (id, message, reply, mode, timestamp) VALUES (?, ?, ?, ?, ?)",
+                    rows
+                )
+        await self._run(insert)
+
+    async def replace_sent_replies(self, items_oldest_first: Iterable[SentReplyItem]):
+        rows = [(item.id, item.message, item.reply, item.mode, item.timestamp) for item in items_oldest_first]
+
+        def replace(conn):
+            with conn:
+                conn.execute("DELETE FROM sent_replies")
+                conn.executemany(
+                    "INSERT INTO sent_replies (id, message, reply, mode, timestamp) VALUES (?, ?, ?, ?, ?)",
+                    rows
+                )
+        await self._run(replace)
+
+    # Webhook logs
+    async def get_webhook_logs(self, limit: int) -> List[WebhookLog]:
+        def query(conn):
+            rows = conn.execute(
+                "SELECT timestamp, type, data FROM webhook_logs ORDER BY seq DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+            return [WebhookLog(timestamp=row[0], type=row[1], data=json.loads(row[2])) for row in rows]
+        return await self._run(query)
+
+    async def add_webhook_logs(self, logs_oldest_first: Iterable[WebhookLog]):
+        rows = [(log.timestamp, log.type, json.dumps(log.data, ensure_ascii=False)) for log in logs_oldest_first]
+
+        def insert(conn):
+            with conn:
+                conn.executemany("INSERT INTO webhook_logs (timestamp, type, data) VALUES (?, ?, ?)", rows)
+        await self._run(insert)
+
+    async def trim_table(self, table: str, keep: int):
+        """Delete all but the newest keep rows of an append-only table"""
+        def trim(conn):
+            with conn:
+                conn.execute(
+                    f"DELETE FROM {table} WHERE seq <= (SELECT seq FROM {table} ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                    (keep,)
+                )
+        await self._run(trim)
+
+    # Facebook config
+    async def get_facebook_configs(self) -> List[FacebookConfig]:
+        def query(conn):
+            rows = conn.execute(
+                "SELECT page_id, page_name, access_token, verify_token, webhook_url, is_connected "
+                "FROM facebook_config ORDER BY seq"
+            ).fetchall()
+            return [_facebook_config(row) for row in rows]
+        return await self._run(query)
+
+    async def save_facebook_config(self, config: FacebookConfig, replace_page_id: Optional[str] = None):
+        def upsert(conn):
+            with conn:
+                if replace_page_id is not None:
+                    conn.execute("DELETE FROM facebook_config WHERE page_id = ?", (replace_page_id,))
+                conn.execute(
+                    "INSERT INTO facebook_config "
+                    "(page_id, page_name, access_token, verify_token, webhook_url, is_connected, seq) "
+                    "VALUES (?, ?, ?, ?, ?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM facebook_config)) "
+                    "ON CONFLICT(page_id) DO UPDATE SET page_name = excluded.page_name, "
+                    "access_token = excluded.access_token, verify_token = excluded.verify_token, "
+                    "webhook_url = excluded.webhook_url, is_connected = excluded.is_connected",
+                    (config.pageId, config.pageName, config.accessToken, config.verifyToken,
+                     config.webhookUrl, int(config.isConnected))
+                )
+        await self._run(upsert)
+
+    async def delete_facebook_config(self, page_id: str) -> bool:
+        def delete(conn):
+            with conn:
+                cursor = conn.execute("DELETE FROM facebook_config WHERE page_id = ?", (page_id,))
+            return cursor.rowcount > 0
+        return await self._run(delete)
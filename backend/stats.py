@@ -0,0 +1,96 @@
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, List
+
+# Throughput windows reported by /api/stats (seconds) and how many recent
+# reply latencies the percentiles are computed from
+STATS_WINDOWS = {"1m": 60, "5m": 300, "15m": 900}
+STATS_LATENCY_SAMPLES = int(os.getenv("STATS_LATENCY_SAMPLES", "2048"))
+
+
+class EventCounter:
+    """Running total plus per-second buckets for throughput over recent windows"""
+
+    def __init__(self, horizon: int = 900):
+        self.total = 0
+        self.horizon = horizon
+        self._buckets: Deque[List[int]] = deque()
+
+    def _expire(self, now: int):
+        while self._buckets and self._buckets[0][0] <= now - self.horizon:
+            self._buckets.popleft()
+
+    def record(self, count: int = 1):
+        now = int(time.monotonic())
+        self.total += count
+        if self._buckets and self._buckets[-1][0] == now:
+            self._buckets[-1][1] += count
+        else:
+            self._buckets.append([now, count])
+        self._expire(now)
+
+    def per_minute(self, window: int) -> float:
+        """Average events per minute over the last window seconds"""
+        now = int(time.monotonic())
+        self._expire(now)
+        count = sum(bucket[1] for bucket in self._buckets if bucket[0] > now - window)
+        return round(count * 60 / window, 3)
+
+
+class LatencyRecorder:
+    """Latency percentiles over the most recent samples"""
+
+    def __init__(self, max_samples: int = 2048):
+        self._samples: Deque[float] = deque(maxlen=max_samples)
+
+    def record(self, latency_ms: float):
+        self._samples.append(latency_ms)
+
+    def percentiles(self) -> Dict[str, float]:
+        samples = sorted(self._samples)
+        if not samples:
+            return {"p50": 0.0, "p95": 0.0, "p99": 0.0}
+        # Nearest-rank percentiles
+        return {
+            name: round(samples[min(len(samples) - 1, int(len(samples) * q))], 3)
+            for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))
+        }
+
+
+# Global counters, updated by the reply and webhook paths
+replies = EventCounter(horizon=max(STATS_WINDOWS.values()))
+reply_latency = LatencyRecorder(STATS_LATENCY_SAMPLES)
+webhook_events = EventCounter(horizon=max(STATS_WINDOWS.values()))
+fallbacks = EventCounter(horizon=max(STATS_WINDOWS.values()))
+
+
+def record_reply(latency_ms: float):
+    """Count a generated reply and its latency"""
+    replies.record()
+    reply_latency.record(latency_ms)
+
+
+def record_fallback():
+    """Count a canned reply sent because the LLM was unavailable"""
+    fallbacks.record()
+
+
+def record_webhook_event():
+    """Count a processed webhook messaging event"""
+    webhook_events.record()
+
+
+def get_counters() -> dict:
+    """Reply and webhook totals, latency percentiles and per-minute throughput"""
+    return {
+        "repliesGenerated": replies.total,
+        "fallbackReplies": fallbacks.total,
+        "webhookEventsProcessed": webhook_events.total,
+        "replyLatencyMs": reply_latency.percentiles(),
+        "throughputPerMinute": {
+            "replies": {name: replies.per_minute(window) for name, window in STATS_WINDOWS.items()},
+            "fallbacks": {name: fallbacks.per_minute(window) for name, window in STATS_WINDOWS.items()},
+            "webhookEvents": {name: webhook_events.per_minute(window) for name, window in STATS_WINDOWS.items()},
+        },
+    }
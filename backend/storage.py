@@ -1,16 +1,66 @@
+import asyncio
 import json
 import os
+import time
 import aiofiles
-from typing import List, Optional
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set, Tuple
 from datetime import datetime
 from models import TrainingDataItem, SentReplyItem, FacebookConfig, WebhookLog
+from jsonl_log import JsonlLog
+from sqlite_store import SqliteStore
+from group_commit import GroupCommitWriter
+from retrieval import normalize_text
+from metrics import storage_duration, timed
+from app_logging import get_logger, fields
 
-DATA_DIR = "data"
+logger = get_logger("storage")
+
+DATA_DIR = os.getenv("DATA_DIR", "data")
 TRAINING_DATA_FILE = os.path.join(DATA_DIR, "training-data.json")
 SENT_REPLIES_FILE = os.path.join(DATA_DIR, "sent-replies.json")
 FACEBOOK_CONFIG_FILE = os.path.join(DATA_DIR, "facebook-config.json")
 WEBHOOK_LOGS_FILE = os.path.join(DATA_DIR, "webhook-logs.json")
 
+# Sent replies and webhook logs are append-only JSONL segments. The *_FILE
+# paths above are the legacy whole-file documents, imported on first use.
+SENT_REPLIES_DIR = os.path.join(DATA_DIR, "sent-replies")
+WEBHOOK_LOGS_DIR = os.path.join(DATA_DIR, "webhook-logs")
+LOG_SEGMENT_BYTES = int(os.getenv("LOG_SEGMENT_BYTES", str(1 << 20)))
+LOG_SEGMENT_AGE = float(os.getenv("LOG_SEGMENT_AGE", "86400"))
+LOG_MAINTENANCE_INTERVAL = float(os.getenv("LOG_MAINTENANCE_INTERVAL", "300"))
+WEBHOOK_LOGS_MAX_RECORDS = int(os.getenv("WEBHOOK_LOGS_MAX_RECORDS", "1000"))
+SENT_REPLIES_MAX_RECORDS = int(os.getenv("SENT_REPLIES_MAX_RECORDS", "0"))
+
+sent_replies_log = JsonlLog(SENT_REPLIES_DIR, LOG_SEGMENT_BYTES, LOG_SEGMENT_AGE, SENT_REPLIES_MAX_RECORDS)
+webhook_logs_log = JsonlLog(WEBHOOK_LOGS_DIR, LOG_SEGMENT_BYTES, LOG_SEGMENT_AGE, WEBHOOK_LOGS_MAX_RECORDS)
+_migrated_logs: Set[str] = set()
+_log_migration_lock = asyncio.Lock()
+_sent_reply_counts: Optional[Dict[str, int]] = None
+_maintenance_task: Optional[asyncio.Task] = None
+
+# Storage backend: "json" (files above) or "sqlite" (one WAL-mode database).
+# A new SQLite database is filled from the JSON files on first use.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", os.path.join(DATA_DIR, "fb-reply.db"))
+
+_sqlite: Optional[SqliteStore] = SqliteStore(SQLITE_PATH) if STORAGE_BACKEND == "sqlite" else None
+_sqlite_lock = asyncio.Lock()
+_sqlite_ready = False
+
+# JSON documents are written by one group-commit writer per file, batching
+# the mutations queued within this many milliseconds into one atomic write
+WRITE_BATCH_WINDOW_MS = float(os.getenv("WRITE_BATCH_WINDOW_MS", "5"))
+
+
+_last_id = 0
+
+
+def new_id() -> str:
+    """Millisecond timestamp id, bumped so ids stay unique under concurrent writes"""
+    global _last_id
+    _last_id = max(int(time.time() * 1000), _last_id + 1)
+    return str(_last_id)
+
 
 def ensure_data_directory():
     """Ensure data directory exists"""
@@ -18,94 +68,609 @@ def ensure_data_directory():
         os.makedirs(DATA_DIR)
 
 
-async def get_training_data() -> List[TrainingDataItem]:
-    """Get all training data"""
-    ensure_data_directory()
+async def _get_sqlite() -> SqliteStore:
+    """Open the SQLite backend, migrating the JSON files into a new database"""
+    global _sqlite_ready
+    assert _sqlite is not None
+    
+    if not _sqlite_ready:
+        async with _sqlite_lock:
+            if not _sqlite_ready:
+                if await _sqlite.open():
+                    await migrate_json_to_sqlite(_sqlite)
+                _sqlite_ready = True
+    return _sqlite
+
+
+# In-memory training data snapshot. Write paths replace it directly, reads only
+# go back to disk when the file's mtime or size changes underneath us.
+_training_snapshot: Optional[List[TrainingDataItem]] = None
+_training_signature: Optional[Tuple[int, int]] = None
+_training_version = 0
+_training_last_updated = "Never"
+
+
+def _file_signature(path: str) -> Optional[Tuple[int, int]]:
+    """Return (mtime_ns, size) for a file, or None if it does not exist"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _set_training_snapshot(data: List[TrainingDataItem], signature: Optional[Tuple[int, int]]):
+    """Replace the training data snapshot and bump its version"""
+    global _training_snapshot, _training_signature, _training_version, _training_last_updated
+    _training_snapshot = list(data)
+    _training_signature = signature
+    _training_version += 1
     
+    _training_last_updated = "Never"
+    if _training_snapshot:
+        try:
+            _training_last_updated = datetime.fromisoformat(_training_snapshot[-1].timestamp).strftime("%Y-%m-%d")
+        except ValueError:
+            _training_last_updated = "Unknown"
+
+
+async def _training_signature_now() -> Optional[Tuple[int, int]]:
+    """Signature that changes when training data is modified outside this process"""
+    if _sqlite is not None:
+        store = await _get_sqlite()
+        return (0, await store.data_version())
+    return _file_signature(TRAINING_DATA_FILE)
+
+
+async def _read_training_file() -> List[TrainingDataItem]:
     if not os.path.exists(TRAINING_DATA_FILE):
         return []
     
     async with aiofiles.open(TRAINING_DATA_FILE, 'r', encoding='utf-8') as f:
         content = await f.read()
-        data = json.loads(content)
-        return [TrainingDataItem(**item) for item in data]
+        return [TrainingDataItem(**item) for item in json.loads(content)]
+
+
+@timed(storage_duration, "get_training_snapshot")
+async def get_training_snapshot() -> Tuple[int, List[TrainingDataItem]]:
+    """Get (version, training data) from the in-memory snapshot.
+
+    The returned list is shared and must not be mutated.
+    """
+    ensure_data_directory()
+    
+    signature = await _training_signature_now()
+    if _training_snapshot is not None and signature == _training_signature:
+        return _training_version, _training_snapshot
+    
+    if _sqlite is not None:
+        data = await (await _get_sqlite()).get_training_data()
+    else:
+        data = await _read_training_file()
+    
+    _set_training_snapshot(data, signature)
+    return _training_version, _training_snapshot
+
+
+async def get_training_summary() -> Tuple[int, str]:
+    """Get the training item count and last update date without copying the data"""
+    await get_training_snapshot()
+    return len(_training_snapshot or []), _training_last_updated
+
+
+async def get_training_data() -> List[TrainingDataItem]:
+    """Get all training data"""
+    _, data = await get_training_snapshot()
+    return list(data)
+
+
+def _serialize_json(data: Any) -> bytes:
+    return json.dumps(data, indent=2, ensure_ascii=False).encode("utf-8")
+
+
+async def _current_training_data() -> List[TrainingDataItem]:
+    _, data = await get_training_snapshot()
+    return data
+
+
+def _commit_training_data(data: List[TrainingDataItem]):
+    _set_training_snapshot(data, _file_signature(TRAINING_DATA_FILE))
+
+
+_training_writer: GroupCommitWriter[List[TrainingDataItem]] = GroupCommitWriter(
+    TRAINING_DATA_FILE,
+    load=_current_training_data,
+    serialize=lambda data: _serialize_json([item.model_dump(exclude_none=True) for item in data]),
+    on_commit=_commit_training_data,
+    window=WRITE_BATCH_WINDOW_MS / 1000
+)
+
 
+TrainingMutation = Callable[[List[TrainingDataItem]], Tuple[List[TrainingDataItem], Any]]
 
+
+async def _mutate_training_data(mutate: TrainingMutation) -> Any:
+    """Apply a mutation to the JSON training data through the group-commit writer"""
+    ensure_data_directory()
+    return await _training_writer.submit(mutate)
+
+
+@timed(storage_duration, "save_training_data")
 async def save_training_data(data: List[TrainingDataItem]):
     """Save training data"""
     ensure_data_directory()
     
-    json_data = [item.model_dump() for item in data]
-    async with aiofiles.open(TRAINING_DATA_FILE, 'w', encoding='utf-8') as f:
-        await f.write(json.dumps(json_data, indent=2, ensure_ascii=False))
+    if _sqlite is not None:
+        store = await _get_sqlite()
+        await store.replace_training_data(data)
+        _set_training_snapshot(data, await _training_signature_now())
+        return
+    
+    await _mutate_training_data(lambda _: (list(data), None))
 
 
-async def get_sent_replies() -> List[SentReplyItem]:
-    """Get all sent replies"""
+@timed(storage_duration, "add_training_item")
+async def add_training_item(item: TrainingDataItem):
+    """Add one training item"""
+    def mutate(data: List[TrainingDataItem]):
+        return data + [item], None
+    
+    if _sqlite is not None:
+        await get_training_snapshot()
+        await (await _get_sqlite()).add_training_items([item])
+        _set_training_snapshot(mutate(_training_snapshot or [])[0], _training_signature)
+    else:
+        await _mutate_training_data(mutate)
+
+
+@timed(storage_duration, "add_training_items")
+async def add_training_items(items: List[TrainingDataItem], dedupe: bool = True) -> List[TrainingDataItem]:
+    """Add many training items in one write, returns the items actually added.
+
+    With dedupe, items whose normalized message already exists for the same
+    page (in the stored data or earlier in the batch) are skipped.
+    """
+    def mutate(data: List[TrainingDataItem]):
+        if not dedupe:
+            return data + items, items
+        
+        seen = {(existing.pageId, normalize_text(existing.message)) for existing in data}
+        added = []
+        for item in items:
+            key = (item.pageId, normalize_text(item.message))
+            if key not in seen:
+                seen.add(key)
+                added.append(item)
+        return data + added, added
+    
+    if _sqlite is not None:
+        _, data = await get_training_snapshot()
+        _, added = mutate(data)
+        if added:
+            await (await _get_sqlite()).add_training_items(added)
+            _set_training_snapshot((_training_snapshot or []) + added, _training_signature)
+        return added
+    
+    return await _mutate_training_data(mutate)
+
+
+@timed(storage_duration, "update_training_item")
+async def update_training_item(item: TrainingDataItem) -> bool:
+    """Replace the training item with the same id, returns False if there is none"""
+    def mutate(data: List[TrainingDataItem]):
+        index = next((i for i, existing in enumerate(data) if existing.id == item.id), None)
+        if index is None:
+            return data, False
+        updated = list(data)
+        updated[index] = item
+        return updated, True
+    
+    if _sqlite is not None:
+        await get_training_snapshot()
+        if not await (await _get_sqlite()).update_training_item(item):
+            return False
+        _set_training_snapshot(mutate(_training_snapshot or [])[0], _training_signature)
+        return True
+    
+    return await _mutate_training_data(mutate)
+
+
+@timed(storage_duration, "delete_training_item")
+async def delete_training_item(item_id: str) -> bool:
+    """Delete a training item, returns False if it does not exist"""
+    def mutate(data: List[TrainingDataItem]):
+        remaining = [item for item in data if item.id != item_id]
+        return remaining, len(remaining) != len(data)
+    
+    if _sqlite is not None:
+        await get_training_snapshot()
+        if not await (await _get_sqlite()).delete_training_item(item_id):
+            return False
+        _set_training_snapshot(mutate(_training_snapshot or [])[0], _training_signature)
+        return True
+    
+    return await _mutate_training_data(mutate)
+
+
+async def _migrate_legacy_log(log: JsonlLog, legacy_file: str):
+    """Import a legacy newest-first JSON document into a JSONL log once.
+
+    Every reader and writer of the log awaits this first, so nothing is
+    appended to the log while the import is still running.
+    """
+    if legacy_file in _migrated_logs:
+        return
+    
+    async with _log_migration_lock:
+        if legacy_file in _migrated_logs:
+            return
+        await _import_legacy_log(log, legacy_file)
+        _migrated_logs.add(legacy_file)
+
+
+async def _import_legacy_log(log: JsonlLog, legacy_file: str):
+    if not os.path.exists(legacy_file):
+        return
+    
+    async with aiofiles.open(legacy_file, 'r', encoding='utf-8') as f:
+        records = list(reversed(json.loads(await f.read())))
+    
+    if not log.is_empty():
+        # Legacy records are older than anything in the log. Skip those already
+        # there, so an import interrupted before the rename below can be re-run.
+        existing = [record async for record in log.iter_newest()]
+        existing.reverse()
+        seen = {json.dumps(record, sort_keys=True) for record in existing}
+        records = [record for record in records if json.dumps(record, sort_keys=True) not in seen] + existing
+    
+    await log.rewrite(records)
+    os.replace(legacy_file, f"{legacy_file}.migrated")
+
+
+def _matches(item: Any, query: Optional[str], since: Optional[str], until: Optional[str]) -> bool:
+    """Text search and timestamp range filter shared by the list endpoints"""
+    if query:
+        needle = query.lower()
+        if needle not in item.message.lower() and needle not in item.reply.lower():
+            return False
+    if since and item.timestamp < since:
+        return False
+    # Prefix comparison so a plain date includes the whole day
+    if until and item.timestamp[:len(until)] > until:
+        return False
+    return True
+
+
+async def iter_training_data(
+    query: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    after: Optional[str] = None,
+    page_id: Optional[str] = None
+) -> AsyncIterator[TrainingDataItem]:
+    """Iterate over matching training data, starting after the item with id `after`.
+
+    With page_id, only the items that page replies from: its own and the shared ones.
+    """
+    _, data = await get_training_snapshot()
+    
+    start = 0
+    if after:
+        start = next((i + 1 for i, item in enumerate(data) if item.id == after), len(data))
+    
+    for item in data[start:]:
+        if page_id is not None and item.pageId not in (None, page_id):
+            continue
+        if _matches(item, query, since, until):
+            yield item
+
+
+async def iter_sent_replies(
+    mode: Optional[str] = None,
+    query: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    after: Optional[str] = None
+) -> AsyncIterator[SentReplyItem]:
+    """Iterate over matching sent replies newest first, starting after the reply with id `after`"""
     ensure_data_directory()
     
-    if not os.path.exists(SENT_REPLIES_FILE):
-        return []
+    if _sqlite is not None:
+        store = await _get_sqlite()
+        before_seq = await store.sent_reply_seq(after) if after else None
+        if after and before_seq is None:
+            return
+        while True:
+            page = await store.get_sent_replies_page(before_seq, 500, mode, query, since, until)
+            if not page:
+                return
+            for seq, item in page:
+                yield item
+            before_seq = page[-1][0]
     
-    async with aiofiles.open(SENT_REPLIES_FILE, 'r', encoding='utf-8') as f:
-        content = await f.read()
-        data = json.loads(content)
-        return [SentReplyItem(**item) for item in data]
+    await _migrate_legacy_log(sent_replies_log, SENT_REPLIES_FILE)
+    records = sent_replies_log.iter_newest_after("id", after) if after else sent_replies_log.iter_newest()
+    async for record in records:
+        item = SentReplyItem(**record)
+        if (not mode or item.mode == mode) and _matches(item, query, since, until):
+            yield item
 
 
-async def save_sent_replies(data: List[SentReplyItem]):
-    """Save sent replies"""
+async def get_sent_replies() -> List[SentReplyItem]:
+    """Get all sent replies, newest first"""
+    return [item async for item in iter_sent_replies()]
+
+
+@timed(storage_duration, "get_sent_reply_counts")
+async def get_sent_reply_counts() -> Dict[str, int]:
+    """Get the number of sent replies per mode, counted once and then kept up to date"""
+    global _sent_reply_counts
+    if _sent_reply_counts is None:
+        if _sqlite is not None:
+            counts = await (await _get_sqlite()).count_sent_replies_by_mode()
+        else:
+            counts = {}
+            async for item in iter_sent_replies():
+                counts[item.mode] = counts.get(item.mode, 0) + 1
+        _sent_reply_counts = counts
+    return dict(_sent_reply_counts)
+
+
+@timed(storage_duration, "add_sent_reply")
+async def add_sent_reply(item: SentReplyItem):
+    """Record a sent reply"""
     ensure_data_directory()
     
-    json_data = [item.model_dump() for item in data]
-    async with aiofiles.open(SENT_REPLIES_FILE, 'w', encoding='utf-8') as f:
-        await f.write(json.dumps(json_data, indent=2, ensure_ascii=False))
+    if _sqlite is not None:
+        await (await _get_sqlite()).add_sent_replies([item])
+    else:
+        await _migrate_legacy_log(sent_replies_log, SENT_REPLIES_FILE)
+        await sent_replies_log.append(item.model_dump())
+    start_log_maintenance()
+    
+    if _sent_reply_counts is not None:
+        _sent_reply_counts[item.mode] = _sent_reply_counts.get(item.mode, 0) + 1
 
 
-async def get_facebook_config() -> Optional[FacebookConfig]:
-    """Get Facebook configuration"""
+@timed(storage_duration, "save_sent_replies")
+async def save_sent_replies(data: List[SentReplyItem]):
+    """Replace all sent replies (newest first)"""
+    global _sent_reply_counts
     ensure_data_directory()
     
+    if _sqlite is not None:
+        await (await _get_sqlite()).replace_sent_replies(reversed(data))
+    else:
+        await _migrate_legacy_log(sent_replies_log, SENT_REPLIES_FILE)
+        await sent_replies_log.rewrite(item.model_dump() for item in reversed(data))
+    
+    _sent_reply_counts = {}
+    for item in data:
+        _sent_reply_counts[item.mode] = _sent_reply_counts.get(item.mode, 0) + 1
+
+
+# Facebook page configs by page id in the order they were added, loaded once and then kept up
+# to date by the write paths so the webhook can route events without touching disk
+_facebook_configs: Optional[Dict[str, FacebookConfig]] = None
+_facebook_configs_lock = asyncio.Lock()
+
+
+async def _read_facebook_config_file() -> List[FacebookConfig]:
     if not os.path.exists(FACEBOOK_CONFIG_FILE):
-        return None
+        return []
     
     async with aiofiles.open(FACEBOOK_CONFIG_FILE, 'r', encoding='utf-8') as f:
         content = await f.read()
         data = json.loads(content)
-        return FacebookConfig(**data)
+    
+    # Older files hold a single config object
+    if data is None:
+        return []
+    if isinstance(data, dict):
+        data = [data]
+    return [FacebookConfig(**config) for config in data]
+
+
+async def _load_facebook_configs() -> Dict[str, FacebookConfig]:
+    """The page config index, read from storage on first use"""
+    global _facebook_configs
+    
+    if _facebook_configs is None:
+        async with _facebook_configs_lock:
+            if _facebook_configs is None:
+                ensure_data_directory()
+                if _sqlite is not None:
+                    configs = await (await _get_sqlite()).get_facebook_configs()
+                else:
+                    configs = await _read_facebook_config_file()
+                _facebook_configs = {config.pageId: config for config in configs}
+    return _facebook_configs
+
+
+async def _current_facebook_configs() -> Dict[str, FacebookConfig]:
+    return dict(await _load_facebook_configs())
+
+
+def _commit_facebook_configs(configs: Dict[str, FacebookConfig]):
+    global _facebook_configs
+    _facebook_configs = configs
+
 
+_facebook_config_writer: GroupCommitWriter[Dict[str, FacebookConfig]] = GroupCommitWriter(
+    FACEBOOK_CONFIG_FILE,
+    load=_current_facebook_configs,
+    serialize=lambda configs: _serialize_json([config.model_dump() for config in configs.values()]),
+    on_commit=_commit_facebook_configs,
+    window=WRITE_BATCH_WINDOW_MS / 1000
+)
 
-async def save_facebook_config(config: FacebookConfig):
-    """Save Facebook configuration"""
+
+async def get_facebook_config_index() -> Dict[str, FacebookConfig]:
+    """Page id -> config, served from memory. Must not be mutated."""
+    return await _load_facebook_configs()
+
+
+async def get_facebook_configs() -> List[FacebookConfig]:
+    """Get all Facebook page configurations"""
+    return list((await _load_facebook_configs()).values())
+
+
+async def get_facebook_config(page_id: Optional[str] = None) -> Optional[FacebookConfig]:
+    """Get a page's Facebook configuration, or the last added one without a page id"""
+    configs = await _load_facebook_configs()
+    if page_id is not None:
+        return configs.get(page_id)
+    return next(reversed(configs.values()), None)
+
+
+def _save_into(configs: Dict[str, FacebookConfig], config: FacebookConfig, replace_single: bool) -> Optional[str]:
+    """Upsert config in place, returns the page id it replaced if any"""
+    replaced = None
+    if replace_single and len(configs) == 1 and config.pageId not in configs:
+        replaced = next(iter(configs))
+        del configs[replaced]
+    configs[config.pageId] = config
+    return replaced
+
+
+@timed(storage_duration, "save_facebook_config")
+async def save_facebook_config(config: FacebookConfig, replace_single: bool = False):
+    """Add or update a page's Facebook configuration.
+
+    With replace_single a new page id replaces the only stored page, as a
+    single-page setup expects when the Page ID is corrected. With several
+    pages stored it is added like any other.
+    """
     ensure_data_directory()
     
-    async with aiofiles.open(FACEBOOK_CONFIG_FILE, 'w', encoding='utf-8') as f:
-        await f.write(json.dumps(config.model_dump(), indent=2, ensure_ascii=False))
+    if _sqlite is not None:
+        configs = await _current_facebook_configs()
+        replaced = _save_into(configs, config, replace_single)
+        await (await _get_sqlite()).save_facebook_config(config, replaced)
+        _commit_facebook_configs(configs)
+        return
+    
+    def mutate(configs: Dict[str, FacebookConfig]):
+        _save_into(configs, config, replace_single)
+        return configs, None
+    
+    await _facebook_config_writer.submit(mutate)
 
 
-async def get_webhook_logs() -> List[WebhookLog]:
-    """Get webhook logs"""
+@timed(storage_duration, "delete_facebook_config")
+async def delete_facebook_config(page_id: str) -> bool:
+    """Remove a page's Facebook configuration, returns False if there is none"""
     ensure_data_directory()
     
-    if not os.path.exists(WEBHOOK_LOGS_FILE):
-        return []
+    if _sqlite is not None:
+        configs = await _current_facebook_configs()
+        if not await (await _get_sqlite()).delete_facebook_config(page_id):
+            return False
+        configs.pop(page_id, None)
+        _commit_facebook_configs(configs)
+        return True
     
-    async with aiofiles.open(WEBHOOK_LOGS_FILE, 'r', encoding='utf-8') as f:
-        content = await f.read()
-        data = json.loads(content)
-        return [WebhookLog(**item) for item in data]
+    def mutate(configs: Dict[str, FacebookConfig]):
+        return configs, configs.pop(page_id, None) is not None
+    
+    return await _facebook_config_writer.submit(mutate)
+
+
+@timed(storage_duration, "get_webhook_logs")
+async def get_webhook_logs(limit: int = 100) -> List[WebhookLog]:
+    """Get the most recent webhook logs, newest first"""
+    ensure_data_directory()
+    
+    if _sqlite is not None:
+        return await (await _get_sqlite()).get_webhook_logs(limit)
+    
+    await _migrate_legacy_log(webhook_logs_log, WEBHOOK_LOGS_FILE)
+    return [WebhookLog(**record) for record in await webhook_logs_log.read_newest(limit)]
 
 
+@timed(storage_duration, "save_webhook_log")
 async def save_webhook_log(log: WebhookLog):
     """Save a webhook log entry"""
     ensure_data_directory()
     
-    logs = await get_webhook_logs()
-    logs.insert(0, log)  # Add to beginning
+    if _sqlite is not None:
+        await (await _get_sqlite()).add_webhook_logs([log])
+    else:
+        await _migrate_legacy_log(webhook_logs_log, WEBHOOK_LOGS_FILE)
+        await webhook_logs_log.append(log.model_dump())
+    start_log_maintenance()
+
+
+async def migrate_json_to_sqlite(store: SqliteStore):
+    """Copy the JSON file storage into a SQLite database"""
+    ensure_data_directory()
+    
+    training_data = await _read_training_file()
+    await store.replace_training_data(training_data)
+    
+    await _migrate_legacy_log(sent_replies_log, SENT_REPLIES_FILE)
+    sent_replies = [SentReplyItem(**record) async for record in sent_replies_log.iter_newest()]
+    await store.replace_sent_replies(reversed(sent_replies))
+    
+    await _migrate_legacy_log(webhook_logs_log, WEBHOOK_LOGS_FILE)
+    logs = [WebhookLog(**record) for record in await webhook_logs_log.read_newest()]
+    await store.add_webhook_logs(reversed(logs))
     
-    # Keep only last 100 logs
-    logs = logs[:100]
+    for config in await _read_facebook_config_file():
+        await store.save_facebook_config(config)
     
-    json_data = [item.model_dump() for item in logs]
-    async with aiofiles.open(WEBHOOK_LOGS_FILE, 'w', encoding='utf-8') as f:
-        await f.write(json.dumps(json_data, indent=2, ensure_ascii=False))
+    logger.info("Migrated JSON storage to SQLite", extra=fields(
+        path=store.path, trainingItems=len(training_data), sentReplies=len(sent_replies), webhookLogs=len(logs)
+    ))
+
+
+@timed(storage_duration, "maintain_logs")
+async def maintain_logs():
+    """Rotate, compact and trim the JSONL logs"""
+    global _sent_reply_counts
+    if SENT_REPLIES_MAX_RECORDS > 0:
+        # Retention may drop sent replies, recount them on the next request
+        _sent_reply_counts = None
+    
+    if _sqlite is not None:
+        store = await _get_sqlite()
+        if WEBHOOK_LOGS_MAX_RECORDS > 0:
+            await store.trim_table("webhook_logs", WEBHOOK_LOGS_MAX_RECORDS)
+        if SENT_REPLIES_MAX_RECORDS > 0:
+            await store.trim_table("sent_replies", SENT_REPLIES_MAX_RECORDS)
+        return
+    
+    for log in (sent_replies_log, webhook_logs_log):
+        try:
+            await log.maintain()
+        except Exception as e:
+            logger.error("Error maintaining log", extra=fields(directory=log.directory, error=str(e)))
+
+
+async def _run_log_maintenance():
+    while True:
+        await asyncio.sleep(LOG_MAINTENANCE_INTERVAL)
+        await maintain_logs()
+
+
+def start_log_maintenance():
+    """Start the background log maintenance task.
+
+    Called from the app lifespan and again on every log append, since the WSGI
+    deployment (a2wsgi) never sends lifespan events.
+    """
+    global _maintenance_task
+    if _maintenance_task is None or _maintenance_task.done():
+        _maintenance_task = asyncio.get_running_loop().create_task(_run_log_maintenance())
+
+
+async def stop_log_maintenance():
+    """Stop the background log maintenance task"""
+    global _maintenance_task
+    if _maintenance_task is not None:
+        _maintenance_task.cancel()
+        try:
+            await _maintenance_task
+        except asyncio.CancelledError:
+            pass
+        _maintenance_task = None
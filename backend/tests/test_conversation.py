@@ -0,0 +1,24 @@
+import asyncio
+from conversation import ConversationStore
+
+
+def test_history_keeps_recent_turns():
+    async def run():
+        store = ConversationStore(max_turns=4)
+        for i in range(3):
+            await store.add_exchange("p:u", f"question {i}", f"answer {i}")
+        return await store.get_history("p:u")
+
+    history = asyncio.run(run())
+    assert [message.content for message in history] == ["question 1", "answer 1", "question 2", "answer 2"]
+
+
+def test_zero_max_turns_disables_memory():
+    async def run():
+        store = ConversationStore(max_turns=0)
+        await store.add_exchange("p:u", "my order number is 55", "Thanks!")
+        return await store.get_history("p:u"), len(store)
+
+    history, senders = asyncio.run(run())
+    assert history == []
+    assert senders == 0
@@ -0,0 +1,26 @@
+import asyncio
+import time
+from facebook_service import TokenBucket
+
+
+def test_acquire_gives_up_on_long_pause():
+    async def run():
+        bucket = TokenBucket(rate=10, burst=1)
+        bucket.pause(600)
+        started = time.monotonic()
+        acquired = await bucket.acquire(max_pause=1)
+        return acquired, time.monotonic() - started
+
+    acquired, waited = asyncio.run(run())
+    assert acquired is False
+    assert waited < 0.5
+
+
+def test_acquire_waits_out_short_pause():
+    async def run():
+        bucket = TokenBucket(rate=10, burst=1)
+        bucket.pause(0.05)
+        return await bucket.acquire(max_pause=1)
+
+    assert asyncio.run(run()) is True
+
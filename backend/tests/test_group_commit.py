@@ -0,0 +1,74 @@
+import asyncio
+import json
+import os
+from group_commit import GroupCommitWriter
+
+
+def make_writer(path: str, state: dict) -> GroupCommitWriter:
+    async def load():
+        return list(state["items"])
+
+    def on_commit(items):
+        state["items"] = items
+
+    return GroupCommitWriter(path, load, lambda items: json.dumps(items).encode("utf-8"), on_commit)
+
+
+def test_concurrent_submits_lose_no_writes(tmp_path):
+    path = str(tmp_path / "items.json")
+    state = {"items": []}
+    writer = make_writer(path, state)
+
+    def append(value):
+        def mutate(items):
+            return items + [value], value
+        return mutate
+
+    async def run():
+        return await asyncio.gather(*(writer.submit(append(i)) for i in range(50)))
+
+    results = asyncio.run(run())
+    assert results == list(range(50))
+    with open(path, encoding="utf-8") as f:
+        assert sorted(json.load(f)) == list(range(50))
+    assert sorted(state["items"]) == list(range(50))
+    assert writer.stats()["batches"] < 50
+
+
+def test_failed_mutation_only_fails_its_caller(tmp_path):
+    path = str(tmp_path / "items.json")
+    writer = make_writer(path, {"items": []})
+
+    def broken(items):
+        raise ValueError("bad item")
+
+    async def run():
+        return await asyncio.gather(
+            writer.submit(lambda items: (items + ["a"], "a")),
+            writer.submit(broken),
+            writer.submit(lambda items: (items + ["b"], "b")),
+            return_exceptions=True,
+        )
+
+    first, second, third = asyncio.run(run())
+    assert (first, third) == ("a", "b")
+    assert isinstance(second, ValueError)
+    with open(path, encoding="utf-8") as f:
+        assert json.load(f) == ["a", "b"]
+
+
+def test_write_error_reaches_every_waiter(tmp_path):
+    path = str(tmp_path / "missing" / "items.json")
+    state = {"items": []}
+    writer = make_writer(path, state)
+
+    async def run():
+        return await asyncio.gather(
+            *(writer.submit(lambda items: (items + ["x"], "x")) for _ in range(5)),
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, OSError) for result in results)
+    assert state["items"] == []
+    assert not os.path.exists(path)
@@ -0,0 +1,48 @@
+import asyncio
+import os
+from jsonl_log import JsonlLog
+
+
+def segment_files(directory) -> list:
+    return sorted(name for name in os.listdir(directory) if name.endswith(".jsonl"))
+
+
+def test_rotates_by_size_and_reads_newest_first(tmp_path):
+    log = JsonlLog(str(tmp_path), max_segment_bytes=64)
+
+    async def run():
+        for i in range(10):
+            await log.append({"id": str(i), "text": "x" * 10})
+            await log.maintain()
+        return await log.read_newest(), await log.read_newest(3)
+
+    records, newest = asyncio.run(run())
+    assert len(segment_files(tmp_path)) > 1
+    assert [record["id"] for record in records] == [str(i) for i in reversed(range(10))]
+    assert [record["id"] for record in newest] == ["9", "8", "7"]
+
+
+def test_retention_drops_whole_old_segments(tmp_path):
+    log = JsonlLog(str(tmp_path), max_segment_bytes=64, max_records=5)
+
+    async def run():
+        for i in range(30):
+            await log.append({"id": str(i)})
+            await log.maintain()
+        return await log.read_newest()
+
+    ids = [record["id"] for record in asyncio.run(run())]
+    assert 5 <= len(ids) < 30
+    assert ids == [str(i) for i in reversed(range(30 - len(ids), 30))]
+
+
+def test_iter_newest_after_skips_to_cursor(tmp_path):
+    log = JsonlLog(str(tmp_path), max_segment_bytes=64)
+
+    async def run():
+        for i in range(8):
+            await log.append({"id": str(i)})
+            await log.maintain()
+        return [record["id"] async for record in log.iter_newest_after("id", "5")]
+
+    assert asyncio.run(run()) == ["4", "3", "2", "1", "0"]
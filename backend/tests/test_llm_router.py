@@ -0,0 +1,94 @@
+import asyncio
+from collections import OrderedDict
+import pytest
+from ai_service import LLMScheduler
+from llm_router import CircuitBreaker, CircuitOpenError, LLMBackend, LLMRouter
+
+
+def backend(name: str, failures: int = 5) -> LLMBackend:
+    return LLMBackend(name, None, "model", breaker=CircuitBreaker(failures, cooldown=30))  # type: ignore[arg-type]
+
+
+def test_fails_over_to_the_next_backend():
+    router = LLMRouter([backend("primary"), backend("backup")], hedge=False)
+
+    async def call(target: LLMBackend):
+        if target.name == "primary":
+            raise RuntimeError("upstream error")
+        return target.name
+
+    assert asyncio.run(router.call(call, timeout=1)) == "backup"
+    assert router.stats()["failovers"] == 1
+
+
+def test_breaker_opens_after_consecutive_failures():
+    only = backend("only", failures=2)
+    router = LLMRouter([only], hedge=False)
+    calls = []
+
+    async def call(target: LLMBackend):
+        calls.append(target.name)
+        raise RuntimeError("upstream error")
+
+    async def run():
+        for _ in range(2):
+            with pytest.raises(RuntimeError):
+                await router.call(call, timeout=1)
+        with pytest.raises(CircuitOpenError):
+            await router.call(call, timeout=1)
+
+    asyncio.run(run())
+    # Each call retries once but counts one breaker failure; the second opens
+    # the breaker, so its retry is skipped
+    assert len(calls) == 3
+    assert only.breaker.state == "open"
+
+
+def test_slow_primary_is_hedged_to_the_backup():
+    router = LLMRouter([backend("primary"), backend("backup")], hedge_default_delay=0.02)
+
+    async def call(target: LLMBackend):
+        await asyncio.sleep(1 if target.name == "primary" else 0.01)
+        return target.name
+
+    assert asyncio.run(router.call(call, timeout=2)) == "backup"
+    assert router.stats()["hedgeWins"] == 1
+
+
+def test_single_backend_is_not_hedged_against_itself():
+    router = LLMRouter([backend("only")], hedge_default_delay=0.01)
+    calls = []
+
+    async def call(target: LLMBackend):
+        calls.append(target.name)
+        await asyncio.sleep(0.05)
+        return target.name
+
+    assert asyncio.run(router.call(call, timeout=1)) == "only"
+    assert calls == ["only"]
+
+
+def test_hedges_hold_their_own_scheduler_slot():
+    scheduler = LLMScheduler(2, OrderedDict([("customer", 10), ("dashboard", 10)]))
+    router = LLMRouter([backend("primary"), backend("backup")], hedge_default_delay=0.01)
+    running = []
+    peak = []
+
+    async def call(target: LLMBackend):
+        running.append(target.name)
+        peak.append(len(running))
+        try:
+            await asyncio.sleep(0.05)
+            return target.name
+        finally:
+            running.remove(target.name)
+
+    async def run():
+        return await asyncio.gather(*(
+            router.call(call, timeout=1, slot=lambda timeout: scheduler.slot("customer", timeout))
+            for _ in range(4)
+        ))
+
+    asyncio.run(run())
+    assert max(peak) <= 2
+    assert scheduler.stats()["active"] == 0
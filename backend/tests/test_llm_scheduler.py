@@ -0,0 +1,67 @@
+import asyncio
+from collections import OrderedDict
+import pytest
+from ai_service import LLMScheduler, SchedulerFullError
+
+
+def make_scheduler(max_concurrency: int = 1, queue_limit: int = 10) -> LLMScheduler:
+    return LLMScheduler(max_concurrency, OrderedDict([("customer", queue_limit), ("dashboard", queue_limit)]))
+
+
+def test_customer_waiters_go_before_dashboard_waiters():
+    scheduler = make_scheduler()
+    order = []
+
+    async def job(name: str, priority: str):
+        async with scheduler.slot(priority):
+            order.append(name)
+            await asyncio.sleep(0.01)
+
+    async def run():
+        await scheduler.acquire("dashboard")
+        jobs = [asyncio.create_task(job("dashboard-1", "dashboard"))]
+        await asyncio.sleep(0)
+        jobs.append(asyncio.create_task(job("customer-1", "customer")))
+        jobs.append(asyncio.create_task(job("dashboard-2", "dashboard")))
+        jobs.append(asyncio.create_task(job("customer-2", "customer")))
+        await asyncio.sleep(0)
+        scheduler.release()
+        await asyncio.gather(*jobs)
+
+    asyncio.run(run())
+    assert order == ["customer-1", "customer-2", "dashboard-1", "dashboard-2"]
+    assert scheduler.stats()["active"] == 0
+
+
+def test_full_queue_rejects_at_once():
+    scheduler = make_scheduler(queue_limit=1)
+
+    async def run():
+        await scheduler.acquire("customer")
+        waiter = asyncio.create_task(scheduler.acquire("customer"))
+        await asyncio.sleep(0)
+        with pytest.raises(SchedulerFullError):
+            await scheduler.acquire("customer")
+        scheduler.release()
+        await waiter
+        scheduler.release()
+
+    asyncio.run(run())
+    assert scheduler.stats()["classes"]["customer"]["rejected"] == 1
+    assert scheduler.stats()["active"] == 0
+
+
+def test_acquire_gives_up_at_the_timeout():
+    scheduler = make_scheduler()
+
+    async def run():
+        await scheduler.acquire("customer")
+        with pytest.raises(SchedulerFullError):
+            await scheduler.acquire("customer", timeout=0.01)
+        scheduler.release()
+
+    asyncio.run(run())
+    stats = scheduler.stats()
+    assert stats["classes"]["customer"]["timedOut"] == 1
+    assert stats["classes"]["customer"]["queued"] == 0
+    assert stats["active"] == 0
@@ -0,0 +1,32 @@
+import pytest
+from reply_cache import ReplyCache
+
+
+def shingle_jaccard(a: str, b: str) -> float:
+    """Exact Jaccard similarity of the character 3-grams ReplyCache hashes"""
+    def shingles(text: str) -> set:
+        padded = f" {text} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+    x, y = shingles(a), shingles(b)
+    return len(x & y) / len(x | y)
+
+
+@pytest.mark.parametrize("a, b", [
+    ("are you open today", "are you open tomorrow"),
+    ("what are your opening hours", "what are your opening hours please"),
+    ("how much is shipping to canada", "how much is shipping to mexico"),
+    ("hello", "refund policy"),
+])
+def test_signature_estimates_jaccard_similarity(a, b):
+    cache = ReplyCache(fuzzy=True, num_perm=256, bands=32)
+    sig_a, sig_b = cache._signature(a), cache._signature(b)
+    estimate = sum(1 for x, y in zip(sig_a, sig_b) if x == y) / len(sig_a)
+    assert estimate == pytest.approx(shingle_jaccard(a, b), abs=0.12)
+
+
+def test_fuzzy_lookup_respects_threshold():
+    cache = ReplyCache(fuzzy=True, fuzzy_threshold=0.7)
+    cache.put("what are your opening hours", 1, "9 to 5")
+
+    assert cache.get("what are your opening hours please", 1) == "9 to 5"
+    assert cache.get("are you open tomorrow", 1) is None
@@ -0,0 +1,106 @@
+import asyncio
+import pytest
+import facebook_service
+from conversation import ConversationStore
+from models import MessagingEvent
+from webhook_queue import QueueFullError, RecentIds, WebhookDispatcher, event_id
+
+
+def message(sender_id: str, text: str, mid: str) -> MessagingEvent:
+    return MessagingEvent(senderId=sender_id, text=text, accessToken="token", pageId="page", mid=mid)
+
+
+def test_follow_up_sees_the_earlier_exchange(monkeypatch):
+    histories = {}
+    sent = []
+
+    async def generate_reply(message_text, history=None, priority="dashboard", page_id=None):
+        histories[message_text] = [turn.content for turn in history or []]
+        await asyncio.sleep(0.05)
+        return f"re: {message_text}"
+
+    async def send_facebook_message(recipient_id, message_text, access_token, page_id=None):
+        sent.append(message_text)
+
+    async def save_webhook_log(log):
+        pass
+
+    monkeypatch.setattr(facebook_service, "conversations", ConversationStore())
+    monkeypatch.setattr(facebook_service.ai_service, "generate_reply", generate_reply)
+    monkeypatch.setattr(facebook_service, "send_facebook_message", send_facebook_message)
+    monkeypatch.setattr(facebook_service.storage, "save_webhook_log", save_webhook_log)
+
+    async def handle(event: MessagingEvent):
+        await facebook_service.handle_facebook_message(event.senderId, event.text, event.accessToken, event.pageId)
+
+    async def run():
+        dispatcher = WebhookDispatcher(handle, workers=4)
+        dispatcher.submit([message("user", "my order number is 55", "m1")])
+        await asyncio.sleep(0.01)
+        dispatcher.submit([message("user", "where is it", "m2")])
+        await dispatcher.stop()
+
+    asyncio.run(run())
+    assert histories["where is it"] == ["my order number is 55", "re: my order number is 55"]
+    assert sent == ["re: my order number is 55", "re: where is it"]
+
+
+def test_recent_ids_suppress_redeliveries():
+    ids = RecentIds(max_size=2, ttl=60)
+    key = event_id({"sender": {"id": "user"}, "message": {"mid": "m1", "text": "hi"}})
+    assert key == "message:m1"
+
+    assert not ids.seen(key)
+    ids.add(key)
+    assert ids.seen(key)
+    assert ids.duplicates == 1
+
+    # Oldest ids are forgotten beyond max_size
+    ids.add("message:m2")
+    ids.add("message:m3")
+    assert not ids.seen(key)
+
+
+def test_postbacks_without_mid_use_sender_and_timestamp():
+    event = {"sender": {"id": "user"}, "timestamp": 123, "postback": {"payload": "START"}}
+    assert event_id(event) == "postback:user:123"
+    assert event_id({"sender": {"id": "user"}, "read": {}}) is None
+
+
+def test_back_to_back_messages_are_coalesced():
+    handled = []
+
+    async def handle(event: MessagingEvent):
+        handled.append((event.senderId, event.text))
+
+    async def run():
+        dispatcher = WebhookDispatcher(handle, workers=2, coalesce_delay=0.05)
+        dispatcher.submit([message("user", "hi", "m1"), message("other", "hello", "m2")])
+        dispatcher.submit([message("user", "are you open today?", "m3")])
+        await asyncio.sleep(0.2)
+        stats = dispatcher.stats()
+        await dispatcher.stop()
+        return stats
+
+    stats = asyncio.run(run())
+    assert sorted(handled) == [("other", "hello"), ("user", "hi\nare you open today?")]
+    assert stats["coalesced"] == 1
+    assert stats["processed"] == 2
+
+
+def test_full_queue_rejects_the_whole_batch():
+    async def handle(event: MessagingEvent):
+        await asyncio.sleep(1)
+
+    async def run():
+        dispatcher = WebhookDispatcher(handle, workers=1, max_queue=2)
+        dispatcher.submit([message("a", "one", "m1")])
+        with pytest.raises(QueueFullError):
+            dispatcher.submit([message("b", "two", "m2"), message("c", "three", "m3")])
+        stats = dispatcher.stats()
+        await dispatcher.stop(timeout=0)
+        return stats
+
+    stats = asyncio.run(run())
+    assert stats["enqueued"] == 1
+    assert stats["rejected"] == 2
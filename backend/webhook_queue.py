@@ -0,0 +1,323 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, List, Optional, Set, Tuple
+from models import MessagingEvent
+from facebook_service import handle_facebook_message, start_typing
+from stats import record_webhook_event
+from app_logging import get_logger, fields
+
+logger = get_logger("webhook_queue")
+
+# Webhook worker pool settings
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+
+# Messages from one sender arriving within COALESCE_DELAY_MS of each other are
+# answered together, waiting at most COALESCE_MAX_WAIT_MS. Off by default since
+# the delay is added to every reply; messages arriving while the sender's
+# previous one is being answered are merged either way.
+COALESCE_DELAY_MS = float(os.getenv("COALESCE_DELAY_MS", "0"))
+COALESCE_MAX_WAIT_MS = float(os.getenv("COALESCE_MAX_WAIT_MS", "5000"))
+COALESCE_MAX_SENDERS = int(os.getenv("COALESCE_MAX_SENDERS", "10000"))
+COALESCE_MAX_MESSAGES = int(os.getenv("COALESCE_MAX_MESSAGES", "10"))
+
+# How many redelivered event ids to remember, and for how long (seconds)
+WEBHOOK_DEDUP_SIZE = int(os.getenv("WEBHOOK_DEDUP_SIZE", "10000"))
+WEBHOOK_DEDUP_TTL = float(os.getenv("WEBHOOK_DEDUP_TTL", "3600"))
+
+
+class QueueFullError(Exception):
+    """Raised when the webhook queue cannot take more events"""
+
+
+class RecentIds:
+    """Bounded, time-windowed set of recently seen event ids"""
+
+    def __init__(self, max_size: int = 10000, ttl: float = 3600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._seen: "OrderedDict[str, float]" = OrderedDict()
+        self.duplicates = 0
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def _expire(self, now: float):
+        while self._seen:
+            key, seen_at = next(iter(self._seen.items()))
+            if now - seen_at < self.ttl and len(self._seen) <= self.max_size:
+                break
+            del self._seen[key]
+
+    def seen(self, key: str) -> bool:
+        """Check for a duplicate, counting it as suppressed if found"""
+        self._expire(time.monotonic())
+        if key in self._seen:
+            self.duplicates += 1
+            return True
+        return False
+
+    def add(self, key: str):
+        """Remember an id as processed"""
+        now = time.monotonic()
+        self._seen[key] = now
+        self._seen.move_to_end(key)
+        self._expire(now)
+
+
+def event_id(event: dict) -> Optional[str]:
+    """Get the dedup key of a webhook messaging event"""
+    if "message" in event:
+        mid = event["message"].get("mid")
+        return f"message:{mid}" if mid else None
+
+    if "postback" in event:
+        # Older postbacks have no mid, sender and timestamp identify them instead
+        mid = event["postback"].get("mid")
+        if mid:
+            return f"postback:{mid}"
+        sender_id = event.get("sender", {}).get("id")
+        timestamp = event.get("timestamp")
+        if sender_id and timestamp:
+            return f"postback:{sender_id}:{timestamp}"
+
+    return None
+
+
+class _PendingMessages:
+    __slots__ = ("events", "first_at", "timer")
+
+    def __init__(self, first_at: float):
+        self.events: List[MessagingEvent] = []
+        self.first_at = first_at
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class WebhookDispatcher:
+    """Bounded queue of messaging events drained by a pool of worker tasks.
+
+    A sender's events are handled one at a time: while one is queued or being
+    handled, newer ones are held back and merged, then queued once the handler
+    returns, so replies go out in order and see the earlier exchange. With a
+    coalescing delay set, messages are also held back until the sender pauses.
+    on_accept is called for every event as soon as it is accepted.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[MessagingEvent], Awaitable[None]],
+        on_accept: Optional[Callable[[MessagingEvent], None]] = None,
+        workers: int = 4,
+        max_queue: int = 1000,
+        coalesce_delay: float = 0.0,
+        coalesce_max_wait: float = 5.0,
+        max_pending_senders: int = 10000,
+        max_messages_per_sender: int = 10,
+    ):
+        self.handler = handler
+        self.on_accept = on_accept
+        self.workers = workers
+        self.max_queue = max_queue
+        self.coalesce_delay = coalesce_delay
+        self.coalesce_max_wait = coalesce_max_wait
+        self.max_pending_senders = max_pending_senders
+        self.max_messages_per_sender = max_messages_per_sender
+        self._queue: Optional["asyncio.Queue[Tuple[float, MessagingEvent]]"] = None
+        self._tasks: List[asyncio.Task] = []
+        self._pending: "OrderedDict[Tuple[Optional[str], str], _PendingMessages]" = OrderedDict()
+        self._busy: Set[Tuple[Optional[str], str]] = set()
+        self._stopping = False
+        self.coalesced = 0
+
+        self.enqueued = 0
+        self.dequeued = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self):
+        """Start the worker tasks"""
+        if self._tasks:
+            return
+        self._stopping = False
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10.0):
+        """Give queued events a chance to finish, then stop the workers"""
+        self._stopping = True
+        for key in list(self._pending):
+            self._flush(key)
+        
+        if self._queue is not None and self._tasks:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Stopping webhook workers with events still queued", extra=fields(depth=self.depth))
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, events: List[MessagingEvent]):
+        """Queue events for processing, all or none.
+
+        Raises QueueFullError when the batch does not fit so the webhook can
+        ask Facebook to redeliver it later.
+        """
+        self.start()
+        assert self._queue is not None
+
+        if self._queue.qsize() + len(self._pending) + len(events) > self.max_queue:
+            self.rejected += len(events)
+            raise QueueFullError(f"Webhook queue is full ({self._queue.qsize()}/{self.max_queue})")
+
+        for event in events:
+            if self.on_accept is not None:
+                self.on_accept(event)
+            if self.coalesce_delay > 0 or (event.pageId, event.senderId) in self._busy:
+                self._buffer(event)
+            else:
+                self._enqueue(event)
+
+    def _enqueue(self, event: MessagingEvent):
+        assert self._queue is not None
+        self._busy.add((event.pageId, event.senderId))
+        self._queue.put_nowait((time.monotonic(), event))
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+
+    def _buffer(self, event: MessagingEvent):
+        """Hold a message back until its sender pauses and has no event in flight"""
+        key = (event.pageId, event.senderId)
+        now = time.monotonic()
+
+        pending = self._pending.get(key)
+        if pending is None:
+            if len(self._pending) >= self.max_pending_senders:
+                idle = next((other for other in self._pending if other not in self._busy), None)
+                if idle is not None:
+                    self._flush(idle)
+            pending = self._pending[key] = _PendingMessages(now)
+
+        pending.events.append(event)
+        if pending.timer is not None:
+            pending.timer.cancel()
+            pending.timer = None
+
+        if key in self._busy:
+            # Queued once the sender's current event is handled
+            return
+        if len(pending.events) >= self.max_messages_per_sender:
+            self._flush(key)
+            return
+        self._schedule_flush(key, pending, now)
+
+    def _schedule_flush(self, key: Tuple[Optional[str], str], pending: _PendingMessages, now: float):
+        delay = min(self.coalesce_delay, pending.first_at + self.coalesce_max_wait - now)
+        if delay <= 0 or self._stopping:
+            self._flush(key)
+            return
+        pending.timer = asyncio.get_running_loop().call_later(delay, self._flush, key)
+
+    def _flush(self, key: Tuple[Optional[str], str]):
+        """Queue a sender's held back messages as one event"""
+        pending = self._pending.get(key)
+        if pending is None:
+            return
+        if pending.timer is not None:
+            pending.timer.cancel()
+            pending.timer = None
+        if key in self._busy:
+            return
+        del self._pending[key]
+
+        last = pending.events[-1]
+        if len(pending.events) > 1:
+            self.coalesced += len(pending.events) - 1
+            last = last.model_copy(update={"text": "\n".join(event.text for event in pending.events)})
+        self._enqueue(last)
+
+    def _release(self, key: Tuple[Optional[str], str]):
+        """Let a sender's next events through once the current one is handled"""
+        self._busy.discard(key)
+        pending = self._pending.get(key)
+        if pending is None:
+            return
+        if len(pending.events) >= self.max_messages_per_sender:
+            self._flush(key)
+        else:
+            self._schedule_flush(key, pending, time.monotonic())
+
+    async def _worker(self):
+        assert self._queue is not None
+        while True:
+            enqueued_at, event = await self._queue.get()
+            wait_ms = (time.monotonic() - enqueued_at) * 1000
+            self.dequeued += 1
+            self.total_wait_ms += wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+
+            try:
+                await self.handler(event)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error("Error processing webhook event", extra=fields(error=str(e)))
+            finally:
+                # Before task_done, so stop() also waits for the held back events
+                self._release((event.pageId, event.senderId))
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        """Queue depth, throughput and wait time"""
+        return {
+            "workers": len(self._tasks),
+            "depth": self.depth,
+            "pendingSenders": len(self._pending),
+            "activeSenders": len(self._busy),
+            "coalesced": self.coalesced,
+            "maxDepth": self.max_depth,
+            "capacity": self.max_queue,
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "avgWaitMs": round(self.total_wait_ms / self.dequeued, 3) if self.dequeued else 0.0,
+            "maxWaitMs": round(self.max_wait_ms, 3),
+        }
+
+
+async def _handle_event(event: MessagingEvent):
+    await handle_facebook_message(event.senderId, event.text, event.accessToken, event.pageId)
+    record_webhook_event()
+
+
+def _accept_event(event: MessagingEvent):
+    # Show typing right away rather than after the coalescing window
+    start_typing(event.senderId, event.accessToken, event.pageId)
+
+
+# Global webhook dispatcher and dedup window instances
+webhook_dispatcher = WebhookDispatcher(
+    _handle_event,
+    on_accept=_accept_event,
+    workers=WEBHOOK_WORKERS,
+    max_queue=WEBHOOK_QUEUE_SIZE,
+    coalesce_delay=COALESCE_DELAY_MS / 1000,
+    coalesce_max_wait=COALESCE_MAX_WAIT_MS / 1000,
+    max_pending_senders=COALESCE_MAX_SENDERS,
+    max_messages_per_sender=COALESCE_MAX_MESSAGES,
+)
+recent_event_ids = RecentIds(max_size=WEBHOOK_DEDUP_SIZE, ttl=WEBHOOK_DEDUP_TTL)